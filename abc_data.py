@@ -0,0 +1,179 @@
+from besser.bot.core.property import Property
+from difflib import SequenceMatcher
+from textwrap import shorten
+import json
+import re
+
+SECTION_ABC = 'abc'
+
+ABC_MERGE_SIMILARITY = Property(SECTION_ABC, 'abc.merge_similarity', float, 0.75)
+"""Minimum similarity (0 to 1) between two texts to consider that they describe the same event, belief or consequence."""
+
+ABC_LLM_CONFLICT_RESOLUTION = Property(SECTION_ABC, 'abc.llm_conflict_resolution', bool, False)
+"""Whether to ask the LLM to combine the ABC data when the local merge finds contradicting fields."""
+
+ABC_CONTEXT_MAX_RECORDS = Property(SECTION_ABC, 'abc.context_max_records', int, 3)
+"""Maximum number of incomplete records described to the extraction of a new message (see CBTData.missing_summary)."""
+
+ABC_FIELDS = ('activating_event', 'beliefs_in_event', 'consequences')
+CONTEXT_TEXT_LENGTH = 100
+
+
+def normalize_text(text: str) -> str:
+    """Lowercase a text and remove its punctuation and repeated whitespaces, to compare it with other texts."""
+    return " ".join(re.sub(r"[^\w\s]", " ", text.lower()).split())
+
+def similarity(a: str, b: str) -> float:
+    """Similarity ratio (0 to 1) between two texts, ignoring case, punctuation and whitespaces."""
+    a, b = normalize_text(a), normalize_text(b)
+    if not a or not b:
+        return 0.0
+    if a == b:
+        return 1.0
+    return SequenceMatcher(None, a, b).ratio()
+
+class ABCRecord:
+    """An ABC record of the session data, i.e., the runtime counterpart of agent.ABC_information."""
+    __slots__ = ABC_FIELDS
+
+    def __init__(self, activating_event: str = "", beliefs_in_event: str = "", consequences: str = ""):
+        self.activating_event = activating_event
+        self.beliefs_in_event = beliefs_in_event
+        self.consequences = consequences
+
+    @staticmethod
+    def from_dict(record: dict) -> 'ABCRecord':
+        """Create a record from a dict, keeping only the ABC fields as stripped strings (missing fields are empty)."""
+        return ABCRecord(*(str(record.get(field) or "").strip() for field in ABC_FIELDS))
+
+    def to_dict(self) -> dict:
+        return {field: getattr(self, field) for field in ABC_FIELDS}
+
+    def copy(self) -> 'ABCRecord':
+        return ABCRecord(self.activating_event, self.beliefs_in_event, self.consequences)
+
+    def is_empty(self) -> bool:
+        return not (self.activating_event or self.beliefs_in_event or self.consequences)
+
+    def is_complete(self) -> bool:
+        return bool(self.activating_event and self.beliefs_in_event and self.consequences)
+
+
+class CBTData:
+    """The ABC data of a session. It is parsed once and updated when the extraction of a turn finishes, so the
+    transition checks only read its precomputed flags.
+
+    Attributes:
+        records (list[ABCRecord]): The ABC records extracted from the conversation
+        missing_beliefs (bool): Whether some record has no beliefs yet
+        complete (bool): Whether there are records and all of them have all their fields filled
+        json (str): The records as a JSON list, as sent to the LLM prompts
+    """
+    __slots__ = ('records', 'missing_beliefs', 'complete', 'json')
+
+    def __init__(self, records: list[ABCRecord] = None):
+        self.update(records or [])
+
+    def update(self, records: list[ABCRecord]) -> None:
+        """Replace the records and recompute the flags."""
+        self.records = records
+        self.missing_beliefs = any(not record.beliefs_in_event for record in records)
+        self.complete = bool(records) and all(record.is_complete() for record in records)
+        self.json = json.dumps([record.to_dict() for record in records])
+
+    def merge(self, new: list[dict], threshold: float) -> list[int]:
+        """Merge newly extracted ABC records (see merge_abc_information). Returns the indexes of the conflicting records."""
+        merged, conflicts = merge_abc_information(self.records, [ABCRecord.from_dict(record) for record in new], threshold)
+        self.update(merged)
+        return conflicts
+
+    def replace(self, indexes: list[int], records: list[ABCRecord]) -> None:
+        """Replace some records (e.g. the conflicting ones) with others, placed where the first of them was."""
+        position = min(indexes)
+        kept = [record for index, record in enumerate(self.records) if index not in indexes]
+        self.update(kept[:position] + records + kept[position:])
+
+    def missing_summary(self, max_records: int) -> str:
+        """Compact description of the last `max_records` incomplete records and their missing fields, so the extraction
+        of a new message can relate it to them without sending all the data. Empty if no field is missing. Empty
+        records (e.g. from a COMBINE response or an old snapshot) have nothing to relate to, so they are skipped."""
+        lines = []
+        incomplete = [record for record in self.records if not record.is_complete() and not record.is_empty()]
+        for record in incomplete[-max_records:]:
+            missing = ", ".join(field for field in ABC_FIELDS if not getattr(record, field))
+            field = next(field for field in ABC_FIELDS if getattr(record, field))
+            lines.append(f"- {field}: \"{shorten(getattr(record, field), CONTEXT_TEXT_LENGTH)}\" (missing {missing})")
+        return "\n".join(lines)
+
+
+def parse_abc_information(abc_json: str) -> list[ABCRecord] or None:
+    """Parse a JSON list of ABC records, dropping the empty ones. Return None if the text is not a valid list of ABC
+    records."""
+    try:
+        data = json.loads(abc_json)
+    except (TypeError, ValueError):
+        return None
+    if not isinstance(data, list) or not all(isinstance(record, dict) for record in data):
+        return None
+    records = [ABCRecord.from_dict(record) for record in data]
+    return [record for record in records if not record.is_empty()]
+
+def merge_field(current: str, new: str, threshold: float) -> tuple[str, bool]:
+    """Union of two values of the same ABC field.
+
+    Returns the merged value and whether both values were contradicting (both filled and not similar).
+    """
+    if not new or similarity(current, new) >= threshold:
+        return current or new, False
+    if not current:
+        return new, False
+    current_norm, new_norm = normalize_text(current), normalize_text(new)
+    if new_norm in current_norm:
+        return current, False
+    if current_norm in new_norm:
+        return new, False
+    return f"{current}; {new}", True
+
+def find_matching_record(records: list[ABCRecord], new: ABCRecord, threshold: float) -> ABCRecord or None:
+    """Find the record describing the same activating event as the new record.
+
+    A new record without activating event completes the last record that misses one of the fields it provides.
+    """
+    if not new.activating_event:
+        provided = [field for field in ABC_FIELDS if getattr(new, field)]
+        for record in reversed(records):
+            if any(not getattr(record, field) for field in provided):
+                return record
+        return records[-1] if records else None
+    best_record, best_score = None, threshold
+    for record in records:
+        score = similarity(record.activating_event, new.activating_event)
+        if score >= best_score:
+            best_record, best_score = record, score
+    if best_record is None:
+        best_record = next((record for record in records if not record.activating_event), None)
+    return best_record
+
+def merge_abc_information(current: list[ABCRecord], new: list[ABCRecord], threshold: float = 0.75) -> tuple[list[ABCRecord], list[int]]:
+    """Merge newly extracted ABC records into the current ones, without calling the LLM.
+
+    Records about the same activating event are de-duplicated by text similarity, and their fields are merged
+    (empty beliefs or consequences are filled with the new information).
+
+    Returns the merged records and the indexes of the records with contradicting fields.
+    """
+    merged = [record.copy() for record in current]
+    conflicting = []
+    for new_record in new:
+        if new_record.is_empty():
+            continue
+        record = find_matching_record(merged, new_record, threshold)
+        if record is None:
+            merged.append(new_record.copy())
+            continue
+        for field in ABC_FIELDS:
+            value, conflict = merge_field(getattr(record, field), getattr(new_record, field), threshold)
+            setattr(record, field, value)
+            if conflict and record not in conflicting:
+                conflicting.append(record)
+    return merged, [merged.index(record) for record in conflicting]
@@ -1,29 +1,27 @@
-from langchain.chains import LLMChain
-from langchain.prompts import PromptTemplate
-from langchain_openai import AzureChatOpenAI
-from langchain_openai import ChatOpenAI
-from langchain.prompts import ChatPromptTemplate
-from langchain.prompts import MessagesPlaceholder
-from langchain.memory import ConversationBufferMemory
-from langchain.prompts import (
-    ChatPromptTemplate,
-    HumanMessagePromptTemplate,
-    MessagesPlaceholder,
-)
-from langchain.schema import SystemMessage
-from langchain_core.utils.function_calling import convert_pydantic_to_openai_function
-from langchain.output_parsers.openai_functions import JsonKeyOutputFunctionsParser
 from pydantic.v1 import BaseModel, Field
-from typing import List
+from typing import List, TYPE_CHECKING
 from enum import Enum
+from llm_cache import ResponseCache
+from llm_gateway import LLMGateway
+from llm_pool import Backend, LLMPool, create_backend
+from session_memory import MemoryOverlay
 
+import asyncio
+import json
 import logging
+import threading
 import traceback
 from dotenv import load_dotenv, find_dotenv
 
 import os
+import telemetry
+import token_usage
 _ = load_dotenv(find_dotenv()) 
 
+if TYPE_CHECKING:
+    # LangChain is imported when the LLM is first used, to keep the bot startup fast
+    from langchain.memory.chat_memory import BaseChatMemory
+
 class prompts(Enum):
     EXTRACT = """Extract the relevant information, if not explicitly provided do not guess. Extract partial info."""
     COMBINE = """The user has provided information about adversity events, beliefs and consequences.
@@ -37,6 +35,18 @@ class prompts(Enum):
                 You should provide counterarguments reflecting a positive logical way of thinking.
                 Please be polite and provide a response using an argument per each belief. 
                 Just provide one paragraph per each belief as an answer, do not add any additional context."""
+    PERSONALIZE = """The following JSON is information about the adversity events, beliefs and consequences of the user.
+                The next message has counterarguments to the beliefs, written by a therapist for any user.
+                Please adapt them to the situation of the user, keeping their meaning, and be polite and brief.
+                Just provide one paragraph per each belief as an answer, do not add any additional context."""
+    SUMMARY = """Progressively summarize the lines of conversation provided, adding onto the previous summary (if any)
+                and returning a new summary. Just provide the summary, do not add any additional context."""
+
+# Extraction input of a message when some ABC information of the conversation is still missing
+EXTRACTION_CONTEXT = """Information still missing in the conversation (only to relate the message to it, do not extract it):
+{missing}
+
+Message: {input}"""
 
 
 class ABC_information(BaseModel):
@@ -51,10 +61,20 @@ class ABC_events(BaseModel):
 
 
 class Agent:
+    """LLM client shared by all the bot sessions.
+    The conversation memory of each session is passed explicitly on every call, so concurrent sessions never share history."""
     def __init__(self):
         self._name = None
         self._llm = None
-        self._memory = None
+        self._prompts = {}
+        self._extraction_functions = []
+        self._extraction_parser = None
+        self._model_id = []
+        self._cache: ResponseCache = None
+        self._gateway: LLMGateway = None
+        self._pool: LLMPool = None
+        self._llm_factory = None
+        self._load_lock = threading.Lock()
 
     @property   
     def name(self):
@@ -62,13 +82,32 @@ class Agent:
     
     @property
     def llm(self):
+        self.load()
         return self._llm
+
+    def load(self):
+        """Create the LLM client and build the chains, if not done yet. The set_*_llm methods only choose the LLM,
+        so LangChain is imported and the client is created on first use (or by an explicit call, to warm up)."""
+        if self._llm is not None or self._llm_factory is None:
+            return
+        with self._load_lock:
+            if self._llm is not None:
+                return
+            llm = self._llm_factory()
+            if isinstance(llm, LLMPool):
+                self._build_chains(llm)
+            elif llm is not None:
+                self._build_chains(LLMPool([Backend(self._name, llm)]))
     
     def set_azurechat_llm(self):
         self._name = "azure"
         #self._name = "bot-besser"
+        self._llm_factory = self._azurechat_llm
+
+    def _azurechat_llm(self):
         try:
-            self._llm = AzureChatOpenAI(azure_deployment=os.environ['AZURE_DEPLOYMENT_NAME'], temperature=0)
+            from langchain_openai import AzureChatOpenAI
+            return AzureChatOpenAI(azure_deployment=os.environ['AZURE_DEPLOYMENT_NAME'], temperature=0, **self._client_options())
         except Exception as _:
             logging.error(f"An error occurred configuring LLM '{self._name}', deployment'{os.environ['AZURE_DEPLOYMENT_NAME']}' in endpoint '{os.environ['AZURE_OPENAI_ENDPOINT']}'."
                               f"See the attached exception:")
@@ -76,17 +115,49 @@ class Agent:
     
     def set_chatopenai_llm(self):
         self._name = "openai"
+        self._llm_factory = self._chatopenai_llm
+
+    def _chatopenai_llm(self):
         try:
-            self._llm = ChatOpenAI(temperature=0, openai_api_key=os.environ['OPENAI_API_KEY'])
+            from langchain_openai import ChatOpenAI
+            # stream_usage: the token usage of the streamed responses is reported in their last chunk
+            return ChatOpenAI(temperature=0, openai_api_key=os.environ['OPENAI_API_KEY'], stream_usage=True,
+                              **self._client_options())
         except Exception as _:
             logging.error(f"An error occurred configuring LLM '{self._name}' in API '{os.environ['OPENAI_API_BASE']}'."
                               f"See the attached exception:")
             traceback.print_exc()
-    
-    def set_memory(self, memory: ConversationBufferMemory):
-        self._memory = memory
 
+    def set_llm_pool(self, specs: list[dict], failure_threshold: int, cooldown: float):
+        """Balance the requests between several deployments (see llm_pool.load_backend_specs for the specs format).
+        The first deployment is also used to count tokens."""
+        self._name = "pool"
+        self._llm_factory = lambda: LLMPool([create_backend(spec, self._client_options()) for spec in specs],
+                                            failure_threshold, cooldown)
+
+    def set_llm(self, llm, name:str):
+        """Use an already configured chat model (e.g. a fake LLM for benchmarks), or a pool of them."""
+        self._name = name
+        self._build_chains(llm if isinstance(llm, LLMPool) else LLMPool([Backend(name, llm)]))
+
+    def set_cache(self, cache: ResponseCache):
+        """Cache the responses of the deterministic calls (and of the memory-dependent ones, if the cache allows it)."""
+        self._cache = cache
+
+    def set_gateway(self, gateway: LLMGateway):
+        """Send the LLM requests through a gateway (rate limits, retries, deadlines and de-duplication).
+        It must be set before the LLM client is created."""
+        self._gateway = gateway
+
+    def _client_options(self) -> dict:
+        """Options of the LLM client: when the gateway retries the requests, the client must not retry them too."""
+        if self._gateway is None:
+            return {}
+        return {'max_retries': 0, 'timeout': self._gateway.timeout}
+    
     def chain_prompt(self, sysMessage:str):
+        from langchain.prompts import ChatPromptTemplate, HumanMessagePromptTemplate, MessagesPlaceholder
+        from langchain.schema import SystemMessage
         prompt = ChatPromptTemplate.from_messages(
             [
                 SystemMessage(
@@ -102,40 +173,304 @@ class Agent:
         )
         return prompt
     
-    def extract_abc_information(self, input:str):
+    def _new_extraction_chain(self, llm):
+        """The chain returns the message of the LLM, so the token usage it reports can be read before parsing it."""
+        from langchain.prompts import ChatPromptTemplate
+        from langchain_core.utils.function_calling import convert_pydantic_to_openai_function
         prompt = ChatPromptTemplate.from_messages([
             ("system", prompts.EXTRACT.value),
             ("human", "{input}")
         ])
-        extraction_functions = [convert_pydantic_to_openai_function(ABC_events)]
-        extraction_model_entities = self._llm.bind(functions=extraction_functions, function_call={"name": "ABC_events"})
-        extraction_chain_entities = prompt | extraction_model_entities | JsonKeyOutputFunctionsParser(key_name="abc_information")
-        return extraction_chain_entities.invoke({"input": input})
-    
-    def combine_abc_information(self, abc_json:str, input: str):
-        abc_memory = ConversationBufferMemory(memory_key="chat_history", return_messages=True)
-        abc_memory.chat_memory.add_user_message(abc_json)
-        prompt = self.chain_prompt(sysMessage=prompts.COMBINE.value)
-        llm_chain = LLMChain(prompt=prompt, llm=self._llm , verbose=False, memory=abc_memory)
-        response = llm_chain.predict(human_input=input)
+        self._extraction_functions = [convert_pydantic_to_openai_function(ABC_events)]
+        extraction_model_entities = llm.bind(functions=self._extraction_functions, function_call={"name": "ABC_events"})
+        return prompt | extraction_model_entities
+
+    def _build_chains(self, pool: LLMPool):
+        """Build the prompt of every prompts member and the chains of every deployment once, to reuse them in all the calls.
+        The LLM is set last, so the Agent is only seen as loaded when its chains are ready."""
+        from langchain.output_parsers.openai_functions import JsonKeyOutputFunctionsParser
+        for backend in pool.backends:
+            backend.extraction_chain = self._new_extraction_chain(backend.llm)
+            backend.generation_chain = backend.llm
+        self._extraction_parser = JsonKeyOutputFunctionsParser(key_name="abc_information")
+        self._prompts = {prompt: self.chain_prompt(sysMessage=prompt.value) for prompt in prompts if prompt is not prompts.EXTRACT}
+        self._model_id = [self._name] + [[backend.name, getattr(backend.llm, "model_name", None),
+                                          getattr(backend.llm, "deployment_name", None)] for backend in pool.backends]
+        self._pool = pool
+        self._llm = pool.backends[0].llm
+
+    def _request_key(self, *parts):
+        """Content hash of an LLM request, used to cache it and to de-duplicate it in the gateway.
+        It is None if nothing uses it, or if the response is not deterministic (temperature other than 0)."""
+        if (self._cache is None and self._gateway is None) or getattr(self._llm, "temperature", 0) != 0:
+            return None
+        return ResponseCache.key(*self._model_id, *parts)
+
+    def _messages_key(self, messages):
+        return self._request_key([[message.type, message.content] for message in messages])
+
+    def _cacheable(self, key, generative: bool):
+        """Memory-dependent (generative) calls are only cached if the cache allows it."""
+        return key is not None and self._cache is not None and (not generative or self._cache.cache_generative)
+
+    def _cache_get(self, key, generative: bool):
+        return self._cache.get(key) if self._cacheable(key, generative) else None
+
+    def _cache_set(self, key, generative: bool, value):
+        if self._cacheable(key, generative):
+            self._cache.set(key, value)
+
+    async def _acache_get(self, key, generative: bool):
+        """Async version of _cache_get. A blocking (e.g. SQLite) cache is read in a thread, so the shared event loop is
+        not blocked."""
+        if self._cacheable(key, generative) and self._cache.blocking:
+            return await asyncio.to_thread(self._cache.get, key)
+        return self._cache_get(key, generative)
+
+    async def _acache_set(self, key, generative: bool, value):
+        if self._cacheable(key, generative) and self._cache.blocking:
+            await asyncio.to_thread(self._cache.set, key, value)
+        else:
+            self._cache_set(key, generative, value)
+
+    def _messages_tokens(self, messages):
+        return lambda: self._llm.get_num_tokens_from_messages(messages)
+
+    @staticmethod
+    def _reported_usage(message) -> tuple[int, int] or None:
+        """Prompt and completion tokens of a request as reported by the provider in the message of the LLM, if any."""
+        usage = getattr(message, 'usage_metadata', None)
+        if usage:
+            return usage['input_tokens'], usage['output_tokens']
+        usage = message.response_metadata.get('token_usage')
+        if usage:
+            return usage['prompt_tokens'], usage['completion_tokens']
+        return None
+
+    def _estimated(self, span, message) -> bool:
+        """Whether the tokens of a response must be estimated locally (see _response)."""
+        return (span.sampled or token_usage.accounting_active()) and self._reported_usage(message) is None
+
+    def _response(self, span, prompt: prompts, tokens, message):
+        """Parse the message of the LLM and count the tokens of the request, for a sampled span and for the token usage
+        of the session (if any). The tokens are the ones reported by the provider, or an estimate if it reports none.
+        It runs once per request sent, so the requests de-duplicated by the gateway and the cached ones are not counted."""
+        response = self._extraction_parser.invoke(message) if prompt is prompts.EXTRACT else message.content
+        if not (span.sampled or token_usage.accounting_active()):
+            return response
+        usage = self._reported_usage(message)
+        if usage is None:
+            completion = message.content or json.dumps(message.additional_kwargs.get('function_call', {}))
+            usage = tokens(), self._llm.get_num_tokens(completion)
+        prompt_tokens, response_tokens = usage
+        if span.sampled:
+            span.set(prompt_tokens=prompt_tokens, response_tokens=response_tokens)
+            telemetry.observe_tokens(prompt.name, prompt_tokens, response_tokens)
+        token_usage.record(prompt.name, prompt_tokens, response_tokens)
         return response
-    
-    def belief_questions(self, input:str):
-        prompt = self.chain_prompt(sysMessage=prompts.QUESTIONS.value)
-        llm_chain = LLMChain(prompt=prompt, llm=self._llm , verbose=False, memory=self._memory)
-        response = llm_chain.predict(human_input=input)
+
+    async def _aresponse(self, span, prompt: prompts, tokens, message):
+        """Async version of _response. The tokens are estimated in a thread, so the shared event loop is not blocked."""
+        if self._estimated(span, message):
+            return await asyncio.to_thread(self._response, span, prompt, tokens, message)
+        return self._response(span, prompt, tokens, message)
+
+    @staticmethod
+    def _chain(prompt: prompts, backend: Backend):
+        return backend.extraction_chain if prompt is prompts.EXTRACT else backend.generation_chain
+
+    def _invoke(self, span, prompt: prompts, chain_input, key, tokens):
+        """Run the chain of a prompt in the pool of deployments, through the gateway if there is one."""
+        def request():
+            message = self._pool.invoke(prompt.name, lambda backend: self._chain(prompt, backend).invoke(chain_input))
+            return self._response(span, prompt, tokens, message)
+        if self._gateway is None:
+            return request()
+        return self._gateway.call(key, tokens, request)
+
+    async def _ainvoke(self, span, prompt: prompts, chain_input, key, tokens):
+        async def request():
+            message = await self._pool.ainvoke(prompt.name,
+                                               lambda backend: self._chain(prompt, backend).ainvoke(chain_input))
+            return await self._aresponse(span, prompt, tokens, message)
+        if self._gateway is None:
+            return await request()
+        return await self._gateway.acall(key, tokens, request)
+
+    def _astream_chain(self, prompt: prompts, chain_input, tokens):
+        def request():
+            return self._pool.astream(prompt.name, lambda backend: self._chain(prompt, backend).astream(chain_input))
+        if self._gateway is None:
+            return request()
+        return self._gateway.astream(tokens, request)
+
+    def _prompt_messages(self, prompt: prompts, memory: 'BaseChatMemory', input:str):
+        self.load()
+        chat_history = memory.load_memory_variables({})["chat_history"]
+        messages = self._prompts[prompt].format_messages(chat_history=chat_history, human_input=input)
+        if hasattr(memory, 'add_prompt_tokens') and token_usage.accounting_active():
+            memory.add_prompt_tokens(self._llm.get_num_tokens_from_messages(messages))
+        return messages
+
+    async def _aprompt_messages(self, prompt: prompts, memory: 'BaseChatMemory', input:str):
+        """Async version of _prompt_messages. The prompt is tokenized in a thread, so the shared event loop is not
+        blocked."""
+        if hasattr(memory, 'add_prompt_tokens') and token_usage.accounting_active():
+            return await asyncio.to_thread(self._prompt_messages, prompt, memory, input)
+        return self._prompt_messages(prompt, memory, input)
+
+    def _call(self, prompt: prompts, chain_input, key, tokens, generative: bool):
+        """Answer a request from the cache, or send it to the LLM and cache its response, in a span that records the
+        tokens of the request."""
+        with telemetry.span('llm', prompt.name) as span:
+            response = cached = self._cache_get(key, generative)
+            if response is None:
+                response = self._invoke(span, prompt, chain_input, key, tokens)
+                self._cache_set(key, generative, response)
+            span.set(cached=cached is not None)
         return response
-    
-    def complete_questions(self, abc_json:str, input:str):
-        abc_memory = self._memory.copy()
-        abc_memory.chat_memory.add_ai_message(abc_json)
-        prompt = self.chain_prompt(sysMessage=prompts.COMPLETE.value)
-        llm_chain = LLMChain(prompt=prompt, llm=self._llm , verbose=False, memory=abc_memory)
-        response = llm_chain.predict(human_input=input)
+
+    async def _acall(self, prompt: prompts, chain_input, key, tokens, generative: bool):
+        """Async version of _call."""
+        with telemetry.span('llm', prompt.name) as span:
+            response = cached = await self._acache_get(key, generative)
+            if response is None:
+                response = await self._ainvoke(span, prompt, chain_input, key, tokens)
+                await self._acache_set(key, generative, response)
+            span.set(cached=cached is not None)
         return response
-    
-    def counterarguments_for_fallacies(self, input:str):
-        prompt = self.chain_prompt(sysMessage=prompts.TREATMENT.value)
-        llm_chain = LLMChain(prompt=prompt, llm=self._llm , verbose=False, memory=self._memory)
-        response = llm_chain.predict(human_input=input)
-        return response
\ No newline at end of file
+
+    def _predict(self, prompt: prompts, memory: 'BaseChatMemory', input:str, messages=None):
+        """Generate the reply to an input and save both in the memory. The prompt messages are built from the chat
+        history, unless they are given."""
+        messages = messages or self._prompt_messages(prompt, memory, input)
+        response = self._call(prompt, messages, self._messages_key(messages), self._messages_tokens(messages), True)
+        memory.save_context({"human_input": input}, {"text": response})
+        return response
+
+    async def _apredict(self, prompt: prompts, memory: 'BaseChatMemory', input:str, messages=None):
+        messages = messages or await self._aprompt_messages(prompt, memory, input)
+        response = await self._acall(prompt, messages, self._messages_key(messages), self._messages_tokens(messages),
+                                     True)
+        memory.save_context({"human_input": input}, {"text": response})
+        return response
+
+    async def _astream(self, prompt: prompts, memory: 'BaseChatMemory', input:str, messages=None):
+        messages = messages or await self._aprompt_messages(prompt, memory, input)
+        key, tokens = self._messages_key(messages), self._messages_tokens(messages)
+        with telemetry.span('llm', prompt.name) as span:
+            response = cached = await self._acache_get(key, True)
+            if response is not None:
+                yield response
+            else:
+                message = None
+                async for chunk in self._astream_chain(prompt, messages, tokens):
+                    # The chunks are added up to read the token usage reported at the end of the stream
+                    message = chunk if message is None else message + chunk
+                    if chunk.content:
+                        yield chunk.content
+                response = await self._aresponse(span, prompt, tokens, message) if message is not None else ""
+                await self._acache_set(key, True, response)
+            span.set(cached=cached is not None)
+        memory.save_context({"human_input": input}, {"text": response})
+
+    def _combine_messages(self, abc_json:str, input:str):
+        from langchain.schema import HumanMessage
+        self.load()
+        return self._prompts[prompts.COMBINE].format_messages(chat_history=[HumanMessage(content=abc_json)], human_input=input)
+
+    def _summary_messages(self, messages, summary:str):
+        from langchain.schema import HumanMessage
+        from langchain_core.messages import get_buffer_string
+        self.load()
+        chat_history = [HumanMessage(content=summary)] if summary else []
+        return self._prompts[prompts.SUMMARY].format_messages(chat_history=chat_history,
+                                                              human_input=get_buffer_string(messages))
+
+    def summarize(self, messages, summary:str):
+        """New running summary of a chat history with its oldest messages (see summary_memory.SessionMemory)."""
+        messages = self._summary_messages(messages, summary)
+        return self._call(prompts.SUMMARY, messages, self._messages_key(messages), self._messages_tokens(messages), True)
+
+    def _extraction_key(self, input:str):
+        self.load()
+        return self._request_key(self._extraction_functions, prompts.EXTRACT.value, input)
+
+    def _extraction_tokens(self, input:str):
+        """Estimated prompt tokens of an extraction, including the schema of its function."""
+        return lambda: self._llm.get_num_tokens(prompts.EXTRACT.value + input + json.dumps(self._extraction_functions))
+
+    @staticmethod
+    def _extraction_input(input:str, missing:str):
+        """Only the new message is extracted, with a compact summary of the missing fields (see CBTData.missing_summary)
+        instead of the whole ABC data, so the prompt does not grow with the conversation."""
+        return EXTRACTION_CONTEXT.format(missing=missing, input=input) if missing else input
+
+    def extract_abc_information(self, input:str, missing:str = ""):
+        input = self._extraction_input(input, missing)
+        return self._call(prompts.EXTRACT, {"input": input}, self._extraction_key(input), self._extraction_tokens(input),
+                          False)
+
+    async def aextract_abc_information(self, input:str, missing:str = ""):
+        input = self._extraction_input(input, missing)
+        return await self._acall(prompts.EXTRACT, {"input": input}, self._extraction_key(input),
+                                 self._extraction_tokens(input), False)
+
+    def combine_abc_information(self, abc_json:str, input: str):
+        messages = self._combine_messages(abc_json, input)
+        return self._call(prompts.COMBINE, messages, self._messages_key(messages), self._messages_tokens(messages), False)
+
+    async def acombine_abc_information(self, abc_json:str, input: str):
+        messages = self._combine_messages(abc_json, input)
+        return await self._acall(prompts.COMBINE, messages, self._messages_key(messages), self._messages_tokens(messages),
+                                 False)
+
+    def belief_questions(self, memory: 'BaseChatMemory', input:str):
+        return self._predict(prompts.QUESTIONS, memory, input)
+
+    async def abelief_questions(self, memory: 'BaseChatMemory', input:str):
+        return await self._apredict(prompts.QUESTIONS, memory, input)
+
+    def astream_belief_questions(self, memory: 'BaseChatMemory', input:str):
+        return self._astream(prompts.QUESTIONS, memory, input)
+
+    @staticmethod
+    def _with_abc_data(memory: 'BaseChatMemory', abc_json:str):
+        """The memory with the ABC data as the last AI message of the prompt, without adding it to the chat history."""
+        from langchain.schema import AIMessage
+        return MemoryOverlay(memory, [AIMessage(content=abc_json)])
+
+    def complete_questions(self, memory: 'BaseChatMemory', abc_json:str, input:str):
+        return self._predict(prompts.COMPLETE, self._with_abc_data(memory, abc_json), input)
+
+    async def acomplete_questions(self, memory: 'BaseChatMemory', abc_json:str, input:str):
+        return await self._apredict(prompts.COMPLETE, self._with_abc_data(memory, abc_json), input)
+
+    def astream_complete_questions(self, memory: 'BaseChatMemory', abc_json:str, input:str):
+        return self._astream(prompts.COMPLETE, self._with_abc_data(memory, abc_json), input)
+
+    def counterarguments_for_fallacies(self, memory: 'BaseChatMemory', input:str):
+        return self._predict(prompts.TREATMENT, memory, input)
+
+    async def acounterarguments_for_fallacies(self, memory: 'BaseChatMemory', input:str):
+        return await self._apredict(prompts.TREATMENT, memory, input)
+
+    def astream_counterarguments_for_fallacies(self, memory: 'BaseChatMemory', input:str):
+        return self._astream(prompts.TREATMENT, memory, input)
+
+    def _personalize_messages(self, abc_json:str, counterarguments:str):
+        """The library counterarguments are personalized with the ABC data only, without the chat history."""
+        from langchain.schema import HumanMessage
+        self.load()
+        return self._prompts[prompts.PERSONALIZE].format_messages(chat_history=[HumanMessage(content=abc_json)],
+                                                                  human_input=counterarguments)
+
+    def personalize_counterarguments(self, memory: 'BaseChatMemory', abc_json:str, counterarguments:str):
+        return self._predict(prompts.PERSONALIZE, memory, abc_json, self._personalize_messages(abc_json, counterarguments))
+
+    async def apersonalize_counterarguments(self, memory: 'BaseChatMemory', abc_json:str, counterarguments:str):
+        return await self._apredict(prompts.PERSONALIZE, memory, abc_json,
+                                    self._personalize_messages(abc_json, counterarguments))
+
+    def astream_personalize_counterarguments(self, memory: 'BaseChatMemory', abc_json:str, counterarguments:str):
+        return self._astream(prompts.PERSONALIZE, memory, abc_json, self._personalize_messages(abc_json, counterarguments))
@@ -0,0 +1,178 @@
+"""Offline ABC extraction over a JSONL file of transcripts, for QA and prompt evaluation.
+
+Every input line is a JSON object with an id and a text (the 'id' and 'text' fields by default; e.g. use
+`--id-field request_id --text-field body` for requests.jsonl). Every output line has the id and the extracted
+ABC_events and, with --counterarguments, the counterarguments to its beliefs. The output is written after every batch
+and is also the checkpoint: running the same command again skips the records already in it. The records that failed
+are written to <output>.errors.jsonl and retried in the next run.
+
+The LLM is configured like the bot: the OPENAI_API_TYPE environment variable (or the llm_pool section), and the
+llm_gateway and llm_cache sections of the config file.
+
+    python batch_extract.py transcripts.jsonl abc.jsonl [--counterarguments] [--batch-size 32] [--max-concurrency 8]
+"""
+from besser.bot.core.property import Property
+from configparser import ConfigParser
+from typing import Iterator, TextIO
+
+from agent import ABC_events, Agent
+from llm_cache import LLM_CACHE_BACKEND, LLM_CACHE_GENERATIVE, LLM_CACHE_MAX_ENTRIES, LLM_CACHE_SQLITE_PATH, LLM_CACHE_TTL, create_cache
+from llm_gateway import LLM_GATEWAY_MAX_RETRIES, LLM_GATEWAY_RETRY_BASE_DELAY, LLM_GATEWAY_RETRY_MAX_DELAY, LLM_GATEWAY_RPM, LLM_GATEWAY_TIMEOUT, LLM_GATEWAY_TPM, LLMGateway
+from llm_pool import LLM_POOL_COOLDOWN, LLM_POOL_FAILURE_THRESHOLD, LLM_POOL_FILE, load_backend_specs
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import time
+
+
+def get_property(config: ConfigParser, prop: Property):
+    """Value of a bot property in the config file, or its default value (like Bot.get_property, without a Bot)."""
+    if not config.has_option(prop.section, prop.name):
+        return prop.default_value
+    getter = {bool: config.getboolean, int: config.getint, float: config.getfloat}.get(prop.type, config.get)
+    return getter(prop.section, prop.name)
+
+def create_agent(config: ConfigParser) -> Agent:
+    """Create the Agent with the LLM, cache and gateway configuration of the bot."""
+    agent = Agent()
+    if get_property(config, LLM_POOL_FILE):
+        agent.set_llm_pool(load_backend_specs(get_property(config, LLM_POOL_FILE)),
+                           failure_threshold=get_property(config, LLM_POOL_FAILURE_THRESHOLD),
+                           cooldown=get_property(config, LLM_POOL_COOLDOWN))
+    elif os.environ['OPENAI_API_TYPE'] == "openai":
+        agent.set_chatopenai_llm()
+    elif os.environ['OPENAI_API_TYPE'] == "azure":
+        agent.set_azurechat_llm()
+    agent.set_cache(create_cache(
+        backend=get_property(config, LLM_CACHE_BACKEND),
+        max_entries=get_property(config, LLM_CACHE_MAX_ENTRIES),
+        ttl=get_property(config, LLM_CACHE_TTL),
+        sqlite_path=get_property(config, LLM_CACHE_SQLITE_PATH),
+        cache_generative=get_property(config, LLM_CACHE_GENERATIVE),
+    ))
+    agent.set_gateway(LLMGateway(
+        rpm=get_property(config, LLM_GATEWAY_RPM),
+        tpm=get_property(config, LLM_GATEWAY_TPM),
+        max_retries=get_property(config, LLM_GATEWAY_MAX_RETRIES),
+        retry_base_delay=get_property(config, LLM_GATEWAY_RETRY_BASE_DELAY),
+        retry_max_delay=get_property(config, LLM_GATEWAY_RETRY_MAX_DELAY),
+        timeout=get_property(config, LLM_GATEWAY_TIMEOUT),
+    ))
+    agent.load()
+    return agent
+
+def load_checkpoint(path: str) -> set[str]:
+    """Ids of the records already in the output file. A line partially written when the process stopped is removed."""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, 'rb+') as f:
+        valid = 0
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            try:
+                done.add(str(json.loads(line)['id']))
+            except (ValueError, KeyError):
+                break
+            valid += len(line)
+        f.truncate(valid)
+    return done
+
+def read_records(path: str, id_field: str, text_field: str, done: set[str],
+                 errors: TextIO) -> Iterator[tuple[str, str]]:
+    """Stream the (id, text) of the input records not processed yet. A record without id is identified by its line.
+    The invalid lines (malformed JSON or without text) are written to the errors file and skipped."""
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            record_id = str(number)
+            try:
+                record = json.loads(line)
+                if not isinstance(record, dict):
+                    raise ValueError(f"expected a JSON object, got {type(record).__name__}")
+                record_id = str(record.get(id_field, number))
+                if record_id in done:
+                    continue
+                text = record[text_field]
+            except (ValueError, KeyError) as e:
+                logging.warning(f"Skipping invalid record at line {number} of {path}: {type(e).__name__}: {e}")
+                errors.write(json.dumps({'id': record_id, 'line': number, 'error': f"{type(e).__name__}: {e}"}) + "\n")
+                continue
+            yield record_id, text
+
+
+class BatchExtractor:
+    """Extract the ABC information (and optionally the counterarguments) of batches of records with LangChain batch,
+    running at most `max_concurrency` records at the same time."""
+
+    def __init__(self, agent: Agent, max_concurrency: int, counterarguments: bool):
+        from langchain_core.runnables import RunnableLambda
+        self._agent = agent
+        self._counterarguments = counterarguments
+        self._runnable = RunnableLambda(self._process)
+        self._config = {'max_concurrency': max_concurrency}
+
+    def _process(self, record: tuple[str, str]) -> dict:
+        record_id, text = record
+        abc_events = ABC_events.parse_obj({'abc_information': self._agent.extract_abc_information(text)})
+        result = {'id': record_id, **abc_events.dict()}
+        if self._counterarguments and abc_events.abc_information:
+            from langchain.memory import ConversationBufferMemory
+            # Every record is an independent conversation
+            memory = ConversationBufferMemory(memory_key="chat_history", input_key="human_input", return_messages=True)
+            result['counterarguments'] = self._agent.counterarguments_for_fallacies(
+                memory=memory, input=json.dumps(result['abc_information']))
+        return result
+
+    def run(self, records: list[tuple[str, str]]) -> list[dict or Exception]:
+        return self._runnable.batch(records, config=self._config, return_exceptions=True)
+
+
+def main(input_path: str, output_path: str, id_field: str, text_field: str, batch_size: int, max_concurrency: int,
+         counterarguments: bool, config_path: str) -> None:
+    config = ConfigParser()
+    config.read(config_path)
+    extractor = BatchExtractor(create_agent(config), max_concurrency, counterarguments)
+    done = load_checkpoint(output_path)
+    if done:
+        logging.info(f"Resuming: {len(done)} records already in {output_path}")
+    processed = failed = 0
+    start = time.perf_counter()
+    with open(output_path, 'a') as output, open(f"{output_path}.errors.jsonl", 'a') as errors:
+        records = read_records(input_path, id_field, text_field, done, errors)
+        while batch := list(itertools.islice(records, batch_size)):
+            for (record_id, _), result in zip(batch, extractor.run(batch)):
+                if isinstance(result, Exception):
+                    failed += 1
+                    errors.write(json.dumps({'id': record_id, 'error': f"{type(result).__name__}: {result}"}) + "\n")
+                else:
+                    processed += 1
+                    output.write(json.dumps(result) + "\n")
+            output.flush()
+            errors.flush()
+            elapsed = time.perf_counter() - start
+            logging.info(f"{processed} records extracted, {failed} failed ({processed / elapsed:.1f} records/s)")
+    elapsed = time.perf_counter() - start
+    logging.info(f"Done: {processed} records in {elapsed:.1f}s ({processed / elapsed if elapsed else 0:.1f} records/s), "
+                 f"{failed} failed")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='{levelname} - {asctime}: {message}', style='{')
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input', help='JSONL file with the transcripts')
+    parser.add_argument('output', help='JSONL file with the extracted ABC information (appended to, when resuming)')
+    parser.add_argument('--id-field', default='id')
+    parser.add_argument('--text-field', default='text')
+    parser.add_argument('--batch-size', type=int, default=32, help='records written to the output at once')
+    parser.add_argument('--max-concurrency', type=int, default=8, help='records sent to the LLM at the same time')
+    parser.add_argument('--counterarguments', action='store_true', help='also generate the counterarguments')
+    parser.add_argument('--config', default='config.ini')
+    args = parser.parse_args()
+    main(args.input, args.output, args.id_field, args.text_field, args.batch_size, args.max_concurrency,
+         args.counterarguments, args.config)
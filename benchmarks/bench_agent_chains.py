@@ -0,0 +1,81 @@
+"""Micro-benchmark of the per-call overhead of the Agent chains, using a fake LLM without latency.
+
+It compares the cached chains (built once when the LLM is configured) with the original Agent code, which built its
+prompt and LLMChain on every call (and, for the extraction, converted the function schema and bound the model again).
+
+Run from the repository root:
+
+    python -m benchmarks.bench_agent_chains [iterations]
+"""
+import sys
+import time
+
+from langchain.chains import LLMChain
+from langchain.memory import ConversationBufferMemory
+from langchain.output_parsers.openai_functions import JsonKeyOutputFunctionsParser
+from langchain.prompts import ChatPromptTemplate
+from langchain_core.utils.function_calling import convert_pydantic_to_openai_function
+
+from agent import ABC_events, Agent, prompts
+from benchmarks.fake_llm import FakeChatModel
+
+
+def rebuilt_extraction(llm, input: str):
+    """The original extraction: prompt, function schema, bound model and chain built on every call."""
+    prompt = ChatPromptTemplate.from_messages([
+        ("system", prompts.EXTRACT.value),
+        ("human", "{input}")
+    ])
+    extraction_functions = [convert_pydantic_to_openai_function(ABC_events)]
+    extraction_model_entities = llm.bind(functions=extraction_functions, function_call={"name": "ABC_events"})
+    extraction_chain_entities = prompt | extraction_model_entities | JsonKeyOutputFunctionsParser(key_name="abc_information")
+    return extraction_chain_entities.invoke({"input": input})
+
+
+def rebuilt_predict(agent: Agent, llm, prompt: prompts, memory, input: str):
+    """The original generative calls: prompt and LLMChain built on every call."""
+    llm_chain = LLMChain(prompt=agent.chain_prompt(sysMessage=prompt.value), llm=llm, verbose=False, memory=memory)
+    return llm_chain.predict(human_input=input)
+
+
+def bench(agent: Agent, llm, iterations: int, rebuild: bool) -> dict:
+    """Mean time per call (in microseconds) of every Agent method."""
+    if rebuild:
+        calls = {
+            'extract_abc_information': lambda memory: rebuilt_extraction(llm, "I failed my exam"),
+            'belief_questions': lambda memory: rebuilt_predict(agent, llm, prompts.QUESTIONS, memory, "I feel awful"),
+            'complete_questions': lambda memory: rebuilt_predict(agent, llm, prompts.COMPLETE, memory, "I feel awful"),
+            'counterarguments_for_fallacies': lambda memory: rebuilt_predict(agent, llm, prompts.TREATMENT, memory, "[]"),
+        }
+    else:
+        calls = {
+            'extract_abc_information': lambda memory: agent.extract_abc_information("I failed my exam"),
+            'belief_questions': lambda memory: agent.belief_questions(memory=memory, input="I feel awful"),
+            'complete_questions': lambda memory: agent.complete_questions(memory=memory, abc_json="[]", input="I feel awful"),
+            'counterarguments_for_fallacies': lambda memory: agent.counterarguments_for_fallacies(memory=memory, input="[]"),
+        }
+    results = {}
+    for name, call in calls.items():
+        start = time.perf_counter()
+        for _ in range(iterations):
+            # A fresh memory per call, so the history length does not change between both modes
+            memory = ConversationBufferMemory(memory_key="chat_history", return_messages=True)
+            call(memory)
+        results[name] = (time.perf_counter() - start) / iterations * 1e6
+    return results
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    llm = FakeChatModel()
+    agent = Agent()
+    agent.set_llm(llm, name="fake")
+    rebuilt = bench(agent, llm, iterations, rebuild=True)
+    cached = bench(agent, llm, iterations, rebuild=False)
+    print(f"{'call':<32}{'rebuilt (us)':>14}{'cached (us)':>14}{'saved (us)':>14}")
+    for name in cached:
+        print(f"{name:<32}{rebuilt[name]:>14.1f}{cached[name]:>14.1f}{rebuilt[name] - cached[name]:>14.1f}")
+
+
+if __name__ == '__main__':
+    main()
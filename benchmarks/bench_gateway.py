@@ -0,0 +1,49 @@
+"""Exercise the LLM gateway against the local stub server: concurrent identical extractions (de-duplicated), streamed
+questions and failing requests (retried), under a requests per minute limit.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_gateway [sessions] [rpm] [fail_every]
+"""
+import asyncio
+import os
+import sys
+import time
+
+from langchain.memory import ConversationBufferMemory
+
+from agent import Agent
+from benchmarks.stub_llm_server import StubLLMServer
+from llm_gateway import LLMGateway
+
+PORT = 8100
+
+
+async def session(agent: Agent) -> None:
+    memory = ConversationBufferMemory(memory_key="chat_history", input_key="human_input", return_messages=True)
+    await agent.aextract_abc_information("I failed my exam and I think I am not good enough")
+    async for _ in agent.astream_belief_questions(memory=memory, input="I feel awful"):
+        pass
+
+
+async def main(sessions: int, rpm: int, fail_every: int) -> None:
+    server = StubLLMServer(PORT, latency=0.05, fail_every=fail_every)
+    server.start()
+    os.environ.update({'OPENAI_API_BASE': f'http://localhost:{PORT}/v1', 'OPENAI_API_KEY': 'stub'})
+    gateway = LLMGateway(rpm=rpm, tpm=0, max_retries=5, retry_base_delay=0.1, retry_max_delay=1.0, timeout=5.0)
+    agent = Agent()
+    agent.set_chatopenai_llm()
+    agent.set_gateway(gateway)
+    agent.load()
+    start = time.perf_counter()
+    results = await asyncio.gather(*(session(agent) for _ in range(sessions)), return_exceptions=True)
+    elapsed = time.perf_counter() - start
+    failed = [result for result in results if isinstance(result, Exception)]
+    print(f"{sessions} sessions in {elapsed:.2f}s, {len(failed)} failed, {server.requests} requests to the stub")
+    print(f"Gateway: {gateway.stats()}")
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:]]
+    asyncio.run(main(*(args + [20, 600, 4][len(args):])))
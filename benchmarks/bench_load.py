@@ -0,0 +1,141 @@
+"""Load test of the bot: N concurrent websocket clients go through the whole CBT conversation of the real cbt.py state
+machine (initial_state -> bad_situation_state -> question_state -> incomplete_state -> recommendation_state ->
+end_cbt_state), against a local fake LLM. No network access is needed.
+
+It reports the turn latency percentiles, the throughput, the memory per session and the LLM calls per turn.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_load [--sessions 20] [--latency 0.2] [--port 8799]
+"""
+import argparse
+import json
+import os
+import resource
+import statistics
+import threading
+import time
+
+import websocket
+
+from multiplexing import MESSAGE_ACTION, OPEN_ACTION, envelope
+
+os.environ.setdefault('OPENAI_API_TYPE', 'openai')
+os.environ.setdefault('OPENAI_API_KEY', 'fake')
+
+EVENT = "I failed my exam yesterday and I stayed at home all day"
+BELIEFS = "I think that I am not good enough"
+
+# Fake extraction outputs: the event and consequences first, the beliefs in a second message
+FUNCTION_ARGUMENTS_BY_KEYWORD = {
+    EVENT: {"abc_information": [{"activating_event": "I failed my exam", "beliefs_in_event": "",
+                                 "consequences": "I stayed at home all day"}]},
+    BELIEFS: {"abc_information": [{"activating_event": "I failed my exam", "beliefs_in_event": "I am not good enough",
+                                   "consequences": ""}]},
+}
+
+# User messages of a conversation and the number of bot messages (texts, option lists or streamed replies) they get
+CONVERSATION = [
+    ("Yes, I had bad thoughts or feelings.", 1),  # bad_situation_state
+    (EVENT, 1),  # question_state
+    (BELIEFS, 1),  # incomplete_state
+    ("What can I do about it?", 3),  # recommendation_state
+    ("Yes, it helps. I am good now.", 3),  # end_cbt_state -> initial_state
+]
+GREETING_MESSAGES = 2
+TURN_TIMEOUT = 60
+
+
+def rss_bytes() -> int:
+    """Resident memory of the process."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def receive(ws: websocket.WebSocket, messages: int) -> None:
+    """Wait until the bot sends a number of complete messages (a streamed reply counts once, when it is done)."""
+    while messages:
+        payload = json.loads(json.loads(ws.recv())['message'])
+        if payload['action'] != 'bot_reply_stream' or payload['message']['done']:
+            messages -= 1
+
+
+def client(url: str, latencies: list[float], errors: list[str], done: threading.Barrier) -> None:
+    """Run a whole conversation, recording the latency of every turn. The connection is kept open until all the
+    clients finish, so the memory of all the sessions is measured at once."""
+    try:
+        ws = websocket.create_connection(url, timeout=TURN_TIMEOUT)
+    except Exception as e:
+        errors.append(f"connect: {e}")
+        done.wait()
+        return
+    try:
+        # Every client is the only channel of its connection, so the bot sessions are independent as in the UI
+        ws.send(envelope('load', OPEN_ACTION))
+        receive(ws, GREETING_MESSAGES)
+        for message, replies in CONVERSATION:
+            start = time.perf_counter()
+            ws.send(envelope('load', MESSAGE_ACTION, message=json.dumps({'action': 'user_message', 'message': message})))
+            receive(ws, replies)
+            latencies.append(time.perf_counter() - start)
+    except Exception as e:
+        errors.append(f"{type(e).__name__}: {e}")
+    done.wait()
+    ws.close()
+
+
+def percentile(values: list[float], p: float) -> float:
+    return statistics.quantiles(values, n=100, method='inclusive')[int(p) - 1] if len(values) > 1 else values[0]
+
+
+def main(sessions: int, latency: float, port: int) -> None:
+    import cbt
+    from benchmarks.fake_llm import FakeChatModel
+    from besser.bot.platforms.websocket import WEBSOCKET_HOST, WEBSOCKET_PORT
+    from nlp_cache import train_bot
+
+    fake_llm = FakeChatModel(latency=latency, function_arguments_by_keyword=FUNCTION_ARGUMENTS_BY_KEYWORD)
+    cbt.llm.set_llm(fake_llm, name="fake")
+    cbt.bot.set_property(WEBSOCKET_PORT, port)
+    train_bot(cbt.bot)
+    cbt.bot.run(train=False, sleep=False)
+    url = f"ws://{cbt.bot.get_property(WEBSOCKET_HOST)}:{port}/"
+    time.sleep(1)
+
+    latencies, errors = [], []
+    done = threading.Barrier(sessions + 1)
+    rss_before = rss_bytes()
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(url, latencies, errors, done), daemon=True)
+               for _ in range(sessions)]
+    for thread in threads:
+        thread.start()
+    done.wait()
+    elapsed = time.perf_counter() - start
+    rss_after = rss_bytes()
+    for thread in threads:
+        thread.join()
+    cbt.bot.stop()
+
+    print(f"Sessions: {sessions}, fake LLM latency: {latency}s, failed sessions: {len(errors)}")
+    for error in errors[:5]:
+        print(f"  {error}")
+    if not latencies:
+        return
+    print(f"Turns: {len(latencies)} in {elapsed:.2f}s ({len(latencies) / elapsed:.1f} turns/s)")
+    print(f"Turn latency: p50={percentile(latencies, 50):.3f}s p95={percentile(latencies, 95):.3f}s "
+          f"p99={percentile(latencies, 99):.3f}s max={max(latencies):.3f}s")
+    print(f"Memory per session: {(rss_after - rss_before) / sessions / 1024:.1f} KiB")
+    print(f"LLM calls per turn: {fake_llm.calls / len(latencies):.2f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sessions', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.2, help='seconds the fake LLM waits on every call')
+    parser.add_argument('--port', type=int, default=8799)
+    args = parser.parse_args()
+    main(args.sessions, args.latency, args.port)
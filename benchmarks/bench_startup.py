@@ -0,0 +1,66 @@
+"""Startup benchmark of the bot: time from launching cbt.py until its websocket port accepts connections, and the
+heaviest imports (from `python -X importtime`). The import times go to a temporary file: they are far larger than a
+pipe buffer, and a full pipe would block the bot before it opens its port.
+
+The bot uses the WEBSOCKET_HOST and WEBSOCKET_PORT environment variables (or the .env file), so the port must be
+free. Run from the repository root:
+
+    python -m benchmarks.bench_startup [top_imports]
+"""
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from dotenv import load_dotenv, find_dotenv
+
+STARTUP_TIMEOUT = 300
+
+
+def parse_importtime(stderr: str) -> list[tuple[int, str]]:
+    """Cumulative import time (in microseconds) of every imported module."""
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, module = line[len("import time:"):].split("|")
+        imports.append((int(cumulative), module.strip()))
+    return imports
+
+
+def wait_for_port(host: str, port: int, process: subprocess.Popen, timeout: float) -> float or None:
+    """Seconds until the port accepts a connection, or None if the process exits or the timeout expires."""
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout and process.poll() is None:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            if s.connect_ex((host, port)) == 0:
+                return time.perf_counter() - start
+        time.sleep(0.05)
+    return None
+
+
+def main(top: int) -> None:
+    load_dotenv(find_dotenv())
+    host, port = os.environ['WEBSOCKET_HOST'], int(os.environ['WEBSOCKET_PORT'])
+    script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cbt.py')
+    with tempfile.TemporaryFile('w+') as importtime:
+        process = subprocess.Popen([sys.executable, '-X', 'importtime', script],
+                                   stdout=subprocess.DEVNULL, stderr=importtime, text=True)
+        seconds = wait_for_port(host, port, process, STARTUP_TIMEOUT)
+        process.terminate()
+        process.wait()
+        importtime.seek(0)
+        stderr = importtime.read()
+    if seconds is None:
+        print(f"The bot did not accept connections on {host}:{port} (exit code {process.returncode})")
+    else:
+        print(f"First websocket accept after {seconds:.2f}s")
+    print(f"\n{'cumulative (s)':>14}  module")
+    for cumulative, module in sorted(parse_importtime(stderr), reverse=True)[:top]:
+        print(f"{cumulative / 1e6:>14.3f}  {module}")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20)
@@ -0,0 +1,59 @@
+import asyncio
+import json
+import time
+from typing import Any, List, Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+
+class FakeChatModel(BaseChatModel):
+    """Deterministic local chat model to benchmark the bot without network access.
+
+    When a function call is forced (as in Agent.extract_abc_information) it answers with the
+    `function_arguments_by_keyword` entry whose keyword is in the last message (or with `function_arguments` if none
+    is), otherwise with `reply`. Every call waits `latency` seconds.
+    """
+    reply: str = "What do you think about it? How did it make you feel?"
+    function_arguments: dict = {"abc_information": [{
+        "activating_event": "I failed my exam",
+        "beliefs_in_event": "I am not good enough",
+        "consequences": "I felt sad and stayed at home",
+    }]}
+    function_arguments_by_keyword: dict = {}
+    latency: float = 0.0
+    calls: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat-model"
+
+    def get_token_ids(self, text: str) -> List[int]:
+        # One token per word, to avoid downloading a tokenizer
+        return list(range(len(text.split())))
+
+    def _message(self, messages: List[BaseMessage], **kwargs: Any) -> AIMessage:
+        self.calls += 1
+        function_call = kwargs.get("function_call")
+        if function_call:
+            last_message = messages[-1].content if messages else ""
+            arguments = next((arguments for keyword, arguments in self.function_arguments_by_keyword.items()
+                              if keyword in last_message), self.function_arguments)
+            return AIMessage(content="", additional_kwargs={"function_call": {
+                "name": function_call["name"],
+                "arguments": json.dumps(arguments),
+            }})
+        return AIMessage(content=self.reply)
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None,
+                  **kwargs: Any) -> ChatResult:
+        if self.latency:
+            time.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=self._message(messages, **kwargs))])
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None,
+                         **kwargs: Any) -> ChatResult:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=self._message(messages, **kwargs))])
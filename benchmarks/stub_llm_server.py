@@ -0,0 +1,120 @@
+"""Local stub of the OpenAI chat completions API, to test the bot and the LLM gateway without network access.
+
+It answers every request (streamed or not) with a fixed reply, or with ABC data when a function call is forced.
+It can add latency and fail with 429 (rate limit) or 500 errors, to exercise the retries of the gateway.
+
+Run from the repository root:
+
+    python -m benchmarks.stub_llm_server [--port 8100] [--latency 0.2] [--fail-every 3]
+
+and point the bot to it with OPENAI_API_TYPE=openai, OPENAI_API_BASE=http://localhost:8100/v1 and any OPENAI_API_KEY.
+"""
+import argparse
+import itertools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPLY = "What do you think about it? How did it make you feel?"
+FUNCTION_ARGUMENTS = {"abc_information": [{
+    "activating_event": "I failed my exam",
+    "beliefs_in_event": "I am not good enough",
+    "consequences": "I felt sad and stayed at home",
+}]}
+
+
+class StubLLMServer(ThreadingHTTPServer):
+    """Stub chat completions server. Every `fail_every` requests, one fails with `fail_status`.
+
+    Attributes:
+        requests (int): Number of received requests
+    """
+    daemon_threads = True
+
+    def __init__(self, port: int, latency: float = 0.0, fail_every: int = 0, fail_status: int = 429):
+        super().__init__(('localhost', port), StubLLMHandler)
+        self.latency = latency
+        self.fail_every = fail_every
+        self.fail_status = fail_status
+        self.requests = 0
+        self._counter = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def next_request(self) -> int:
+        with self._lock:
+            self.requests = next(self._counter)
+            return self.requests
+
+    def start(self) -> threading.Thread:
+        """Serve in a background thread."""
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+class StubLLMHandler(BaseHTTPRequestHandler):
+    server: StubLLMServer
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, body: dict, headers: dict = None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        number = self.server.next_request()
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if not self.path.endswith('/chat/completions'):
+            self._send_json(404, {'error': {'message': f'Unknown path {self.path}'}})
+            return
+        if self.server.fail_every and number % self.server.fail_every == 0:
+            self._send_json(self.server.fail_status, {'error': {'message': 'Stub failure', 'type': 'stub'}},
+                            {'Retry-After': '0.1'} if self.server.fail_status == 429 else None)
+            return
+        message = {'role': 'assistant', 'content': REPLY}
+        function_call = request.get('function_call')
+        if isinstance(function_call, dict):
+            message = {'role': 'assistant', 'content': None, 'function_call': {
+                'name': function_call['name'], 'arguments': json.dumps(FUNCTION_ARGUMENTS)}}
+        completion = {'id': f'stub-{number}', 'created': int(time.time()), 'model': request.get('model', 'stub')}
+        if request.get('stream'):
+            self._stream(completion, message)
+        else:
+            self._send_json(200, {**completion, 'object': 'chat.completion',
+                                  'choices': [{'index': 0, 'message': message, 'finish_reason': 'stop'}],
+                                  'usage': {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0}})
+
+    def _stream(self, completion: dict, message: dict):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.end_headers()
+        words = (message['content'] or '').split(' ')
+        deltas = [{'role': 'assistant', 'content': ''}] + [{'content': (' ' if i else '') + word}
+                                                           for i, word in enumerate(words)]
+        for i, delta in enumerate(deltas + [{}]):
+            chunk = {**completion, 'object': 'chat.completion.chunk', 'choices': [
+                {'index': 0, 'delta': delta, 'finish_reason': 'stop' if i == len(deltas) else None}]}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        self.wfile.write(b"data: [DONE]\n\n")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8100)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds to wait before every answer')
+    parser.add_argument('--fail-every', type=int, default=0, help='fail one of every N requests (0 never fails)')
+    parser.add_argument('--fail-status', type=int, default=429, help='HTTP status of the failed requests')
+    args = parser.parse_args()
+    server = StubLLMServer(args.port, args.latency, args.fail_every, args.fail_status)
+    print(f"Stub LLM server listening on http://localhost:{args.port}/v1")
+    server.serve_forever()
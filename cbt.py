@@ -1,18 +1,46 @@
 import logging
 from besser.bot.core.bot import Bot
+from besser.bot.core.processors.processor import Processor
 from besser.bot.core.session import Session
 
 from agent import Agent
-from langchain.memory import ConversationBufferMemory
+from abc_data import ABC_CONTEXT_MAX_RECORDS, ABC_LLM_CONFLICT_RESOLUTION, ABC_MERGE_SIMILARITY, ABCRecord, CBTData, parse_abc_information
+from streaming import STREAMING_ENABLED, stream_reply
+from llm_cache import LLM_CACHE_BACKEND, LLM_CACHE_GENERATIVE, LLM_CACHE_MAX_ENTRIES, LLM_CACHE_SQLITE_PATH, LLM_CACHE_TTL, create_cache
+from llm_gateway import LLM_GATEWAY_MAX_RETRIES, LLM_GATEWAY_RETRY_BASE_DELAY, LLM_GATEWAY_RETRY_MAX_DELAY, LLM_GATEWAY_RPM, LLM_GATEWAY_TIMEOUT, LLM_GATEWAY_TPM, LLMGateway
+from llm_pool import LLM_POOL_COOLDOWN, LLM_POOL_FAILURE_THRESHOLD, LLM_POOL_FILE, load_backend_specs
+from nlp_cache import train_bot
+from recommendation_library import RECOMMENDATIONS_LIBRARY, RECOMMENDATIONS_MIN_SCORE, create_recommendation_library
+from session_store import SESSION_STORE_BACKEND, SESSION_STORE_FLUSH_INTERVAL, SESSION_STORE_SQLITE_PATH, SESSION_STORE_TRANSCRIPT_MESSAGES, SESSION_STORE_TTL, TRANSCRIPT_ACTION, create_session_store
+from turn_executor import EXECUTOR_ASYNC, EXECUTOR_WORKERS, TurnExecutor
+from token_usage import BUDGET_COMPLETION_TOKEN_COST, BUDGET_PROMPT_TOKEN_COST, BUDGET_SESSION_TOKENS, TokenUsage
+from telemetry import TELEMETRY_ENABLED, TELEMETRY_EXPORTER_PORT, TELEMETRY_SAMPLE_RATE
+from multiplexing import use_multiplexing
+from message_filter import EXTRACTION_MIN_WORDS, SMALL_TALK, ExtractionFilter
+from session_memory import MEMORY_MAX_TOKEN_LIMIT, MEMORY_SUMMARY_WORKERS, new_session_memory, start_summary_workers
 from enum import Enum
+from typing import Any, AsyncIterator, Awaitable, Callable, TYPE_CHECKING
+import asyncio
 import json
+import time
 import sys
 from dotenv import load_dotenv, find_dotenv
 import socket
+import telemetry
+import token_usage
+import threading
+import weakref
+from urllib.parse import parse_qs, urlparse
 
 import os
+
+if TYPE_CHECKING:
+    from summary_memory import SessionMemory
+
 _ = load_dotenv(find_dotenv()) 
 
+# Single Agent shared by every session: the LLM client and its HTTP connection pool are reused,
+# while each session passes its own memory on every call.
 llm = Agent()
 
 if os.environ['OPENAI_API_TYPE'] == "openai":
@@ -29,6 +57,53 @@ bot = Bot('CBT_BOT')
 bot.load_properties('config.ini')
 # Define the platform your chatbot will use
 websocket_platform = bot.use_websocket_platform(use_ui=False)
+# The UI sessions are multiplexed over a few websocket connections, each one a channel with its own bot session
+use_multiplexing(websocket_platform, bot)
+# Spans of the state bodies and LLM calls, and latency and token histograms of the sampled turns
+telemetry.configure(enabled=bot.get_property(TELEMETRY_ENABLED), sample_rate=bot.get_property(TELEMETRY_SAMPLE_RATE))
+# Token usage and cost of every session, by state and prompt, with an optional budget per session. The tokens of
+# every LLM call are only counted for a budget, or for the exported metrics
+token_usage.configure(enabled=bot.get_property(BUDGET_SESSION_TOKENS) > 0
+                      or (bot.get_property(TELEMETRY_ENABLED) and bot.get_property(TELEMETRY_EXPORTER_PORT) > 0),
+                      prompt_token_cost=bot.get_property(BUDGET_PROMPT_TOKEN_COST),
+                      completion_token_cost=bot.get_property(BUDGET_COMPLETION_TOKEN_COST))
+response_cache = create_cache(
+    backend=bot.get_property(LLM_CACHE_BACKEND),
+    max_entries=bot.get_property(LLM_CACHE_MAX_ENTRIES),
+    ttl=bot.get_property(LLM_CACHE_TTL),
+    sqlite_path=bot.get_property(LLM_CACHE_SQLITE_PATH),
+    cache_generative=bot.get_property(LLM_CACHE_GENERATIVE),
+)
+llm.set_cache(response_cache)
+# Several deployments balancing the requests, instead of the one of OPENAI_API_TYPE
+if bot.get_property(LLM_POOL_FILE):
+    llm.set_llm_pool(load_backend_specs(bot.get_property(LLM_POOL_FILE)),
+                     failure_threshold=bot.get_property(LLM_POOL_FAILURE_THRESHOLD),
+                     cooldown=bot.get_property(LLM_POOL_COOLDOWN))
+# Rate limits, retries and deadlines of the requests to the LLM provider, shared by all the sessions
+llm_gateway = LLMGateway(
+    rpm=bot.get_property(LLM_GATEWAY_RPM),
+    tpm=bot.get_property(LLM_GATEWAY_TPM),
+    max_retries=bot.get_property(LLM_GATEWAY_MAX_RETRIES),
+    retry_base_delay=bot.get_property(LLM_GATEWAY_RETRY_BASE_DELAY),
+    retry_max_delay=bot.get_property(LLM_GATEWAY_RETRY_MAX_DELAY),
+    timeout=bot.get_property(LLM_GATEWAY_TIMEOUT),
+)
+llm.set_gateway(llm_gateway)
+# Background threads compressing the older chat history of every session
+start_summary_workers(bot.get_property(MEMORY_SUMMARY_WORKERS))
+# Sessions saved after every state body, so they survive restarts and can be resumed by any bot replica
+session_store = create_session_store(
+    backend=bot.get_property(SESSION_STORE_BACKEND),
+    sqlite_path=bot.get_property(SESSION_STORE_SQLITE_PATH),
+    flush_interval=bot.get_property(SESSION_STORE_FLUSH_INTERVAL),
+    ttl=bot.get_property(SESSION_STORE_TTL),
+)
+# Vetted counterarguments of the common cognitive distortions, answered without a full LLM generation
+recommendation_library = create_recommendation_library(bot.get_property(RECOMMENDATIONS_LIBRARY),
+                                                       bot.get_property(RECOMMENDATIONS_MIN_SCORE))
+# Shared event loop running the LLM pipelines of all the sessions, with bounded concurrency
+turn_executor = TurnExecutor(bot.get_property(EXECUTOR_WORKERS)) if bot.get_property(EXECUTOR_ASYNC) else None
 
 
 # STATES
@@ -78,111 +153,288 @@ class bot_messages(Enum):
     end_recommendation = """Does this help you to think about it in a more positive way?"""
     end_options = ['It does not help. I still feel bad.', 'Yes, it helps. I am good now.']
     end_cbt = """I hope you feel better now. Thanks for your time and have a nice day!"""
+    resume = """Welcome back! Let's continue where we left off."""
     fallback = """I'm here to support you. Whenever you feel comfortable, please feel free to share the situation that made you feel bad. 
                 Remember, I'm here to help you think about it in a more positive way.
                 Can you please provide more information about the situation that made you feel bad?"""
 
+# Option buttons, greetings and thanks never contain ABC information, so they are not sent to the LLM extraction
+extraction_filter = ExtractionFilter(
+    options=bot_messages.options.value + bot_messages.end_options.value,
+    small_talk=SMALL_TALK + end_cbt_intent.training_sentences,
+    min_words=bot.get_property(EXTRACTION_MIN_WORDS),
+)
+
+# METRICS
+
+telemetry.add_stats('cbt_llm_gateway', 'LLM gateway requests, retries, coalesced and throttled requests', llm_gateway.stats)
+telemetry.add_gauge('cbt_extraction_skipped', 'Skipped ABC extractions, by reason', lambda: dict(extraction_filter.skipped),
+                    label='reason')
+if response_cache is not None:
+    telemetry.add_stats('cbt_llm_cache', 'LLM response cache hits and misses', response_cache.stats)
+if turn_executor is not None:
+    telemetry.add_stats('cbt_turn_executor', 'Turns queued, running and completed in the turn executor', turn_executor.stats)
+if recommendation_library is not None:
+    telemetry.add_stats('cbt_recommendation_library', 'Recommendations answered from the library and estimated seconds saved',
+                        recommendation_library.stats)
+if session_store is not None:
+    telemetry.add_gauge('cbt_session_store_flushed', 'Session snapshots written to the session store',
+                        lambda: session_store.flushed)
+
+# SESSION STORE
+
+# Connections whose stored session was already looked up (a reset or a new CBT round must not resume it again)
+resumed_connections = weakref.WeakSet()
+
+def session_key(session: Session) -> str or None:
+    """Key of a session in the session store: the 'session' query parameter of the request of its channel."""
+    connection = websocket_platform._connections.get(session.id)
+    if connection is None:
+        return None
+    return parse_qs(urlparse(connection.request.path).query).get('session', [None])[0]
+
+def record_message(session: Session, message: str, is_user: bool):
+    """Add a chat message to the transcript of the session, which is stored to show it again when the session is
+    resumed. Only the latest session_store.transcript_messages messages are kept."""
+    max_messages = bot.get_property(SESSION_STORE_TRANSCRIPT_MESSAGES)
+    if session_store is None or max_messages <= 0:
+        return
+    transcript = session.get('transcript')
+    if transcript is None:
+        transcript = []
+        session.set('transcript', transcript)
+    transcript.append([message, is_user])
+    del transcript[:-max_messages]
+
+def reply(session: Session, message: str):
+    """Reply to the user, recording the reply in the transcript of the session."""
+    record_message(session, message, False)
+    session.reply(message)
+
+class TranscriptProcessor(Processor):
+    """Records the user messages in the transcript of their session."""
+
+    def __init__(self, bot: Bot):
+        super().__init__(bot=bot, user_messages=True)
+
+    def process(self, session: Session, message: str) -> str:
+        record_message(session, message, True)
+        return message
+
+TranscriptProcessor(bot)
+
+def replay_transcript(session: Session):
+    """Send the transcript of a resumed session to the client, so the user sees the conversation again."""
+    connection = websocket_platform._connections.get(session.id)
+    transcript = session.get('transcript')
+    if connection is not None and transcript:
+        connection.send(json.dumps({'action': TRANSCRIPT_ACTION, 'message': transcript}))
+
+def save_session(session: Session):
+    """Save a snapshot of the session (current state, chat memory, ABC data and transcript) in the session store."""
+    key = session.get('store_key')
+    memory: 'SessionMemory' = session.get('bot_memory')
+    if session_store is None or key is None or memory is None:
+        return
+    cbt_struct_data: CBTData = session.get('cbt_struct_data')
+    session_store.save(key, {
+        'state': session.current_state.name,
+        'memory': memory.to_dict(),
+        'cbt_struct_data': None if cbt_struct_data is None else [record.to_dict() for record in cbt_struct_data.records],
+        'token_usage': session.get('token_usage').to_dict(),
+        'transcript': list(session.get('transcript') or []),
+    })
+
+def resume_session(session: Session) -> bool:
+    """Restore the stored session of a new connection, if there is one. Returns whether it was resumed."""
+    connection = websocket_platform._connections.get(session.id)
+    if session_store is None or session.get('store_key') is None or connection in resumed_connections:
+        return False
+    resumed_connections.add(connection)
+    snapshot = session_store.load(session.get('store_key'))
+    if snapshot is None:
+        return False
+    memory = new_session_memory(agent=llm, max_token_limit=bot.get_property(MEMORY_MAX_TOKEN_LIMIT))
+    memory.load_dict(snapshot['memory'])
+    session.set('bot_memory', memory)
+    records = snapshot['cbt_struct_data']
+    session.set('cbt_struct_data', None if records is None else CBTData([ABCRecord.from_dict(record) for record in records]))
+    if 'token_usage' in snapshot:
+        session.get('token_usage').load_dict(snapshot['token_usage'])
+    session.set('transcript', snapshot.get('transcript', []))
+    # The session has no public setter for its state. A state removed since the snapshot resumes in the initial state
+    state = next((state for state in bot.states if state.name == snapshot['state']), None)
+    if state is None:
+        logging.warning(f"Session {session.id} was stored in the unknown state '{snapshot['state']}'. It resumes in "
+                        f"'{initial_state.name}'")
+        state = initial_state
+    session._current_state = state
+    logging.info(f"Session {session.id} resumed in state '{state.name}'")
+    return True
+
+def state_body(body: Callable[[Session], None]) -> Callable[[Session], None]:
+    """Run a state body in the trace of its turn, counting the tokens of its LLM calls in the session token usage, and
+    save the session in the session store afterwards."""
+    def run_body(session: Session):
+        usage: TokenUsage = session.get('token_usage')
+        if usage is None:
+            usage = TokenUsage(bot.get_property(BUDGET_SESSION_TOKENS))
+            session.set('token_usage', usage)
+        with telemetry.trace(session.current_state.name), token_usage.accounting(usage, session.current_state.name):
+            body(session)
+        save_session(session)
+    run_body.__name__ = body.__name__
+    return run_body
 
 # STATES BODIES' DEFINITION + TRANSITIONS
 
 def initial_body(session: Session):
     """Initial state body to be executed when the bot is started."""
-    memory = ConversationBufferMemory(memory_key="chat_history", return_messages=True)
+    session.set('store_key', session_key(session))
+    if resume_session(session):
+        replay_transcript(session)
+        session.reply(bot_messages.resume.value)
+        if session.current_state is initial_state:
+            websocket_platform.reply_options(session, bot_messages.options.value)
+        elif session.current_state is recommendation_state:
+            websocket_platform.reply_options(session, bot_messages.end_options.value)
+        return
+    memory = new_session_memory(agent=llm, max_token_limit=bot.get_property(MEMORY_MAX_TOKEN_LIMIT))
     session.set('bot_memory', memory)
-    llm.set_memory(memory)
 
-    session.reply(bot_messages.initial.value)
+    reply(session, bot_messages.initial.value)
     memory.chat_memory.add_user_message(bot_messages.initial.value)
     websocket_platform.reply_options(session, bot_messages.options.value)
     
-initial_state.set_body(initial_body)
+initial_state.set_body(state_body(initial_body))
 initial_state.when_intent_matched_go_to(bad_situation_intent, bad_situation_state)
 initial_state.when_intent_matched_go_to(end_cbt_intent, end_cbt_state)
 
-def extract_abc_information(session: Session):
-    """Extract ABC (Activating Event, Belief, Consequence) information from the user message and store it as structured data."""
-    cbt_struct_data: str = session.get('cbt_struct_data')
-    print("extract_abc_information", type(cbt_struct_data), cbt_struct_data)
-
-    response = llm.extract_abc_information(session.message)
-    if not (cbt_struct_data is None): print(cbt_struct_data, 'cbt before combine:', len(cbt_struct_data))
-    print(response, 'response before combine:', len(response))
+async def timed(latency: dict, step: str, coro: Awaitable) -> Any:
+    """Await an LLM call and record its duration (in seconds) in the latency breakdown of the turn."""
+    start = time.perf_counter()
+    try:
+        return await coro
+    finally:
+        latency[step] = time.perf_counter() - start
+
+def run_turn(session: Session, turn: Callable[[dict], Awaitable]) -> Any:
+    """Run the async LLM pipeline of a state body and store the latency breakdown of the turn in the session."""
+    latency = {}
+    start = time.perf_counter()
+    # Create the LLM client here if needed, so it is never created inside the shared event loop
+    llm.load()
+    if turn_executor is None:
+        result = asyncio.run(turn(latency))
+    else:
+        result, latency['queue_wait'] = turn_executor.run(session.id, lambda: turn(latency))
+    latency['total'] = time.perf_counter() - start
+    session.set('turn_latency', latency)
+    telemetry.observe_turn(latency)
+    logging.info(f"Turn latency in '{session.current_state.name}': "
+                 + ", ".join(f"{step}={seconds:.3f}s" for step, seconds in latency.items())
+                 + f". Session tokens: {session.get('token_usage').total}")
+    return result
+
+async def first_chunk_timed(latency: dict, step: str, chunks: AsyncIterator[str]) -> AsyncIterator[str]:
+    """Forward the chunks of a streamed LLM reply, recording the time to the first chunk in the latency breakdown."""
+    start = time.perf_counter()
+    async for chunk in chunks:
+        latency.setdefault(f'{step}_first_chunk', time.perf_counter() - start)
+        yield chunk
+
+async def reply_llm(session: Session, latency: dict, step: str,
+                    generate: Callable[[], Awaitable[str]], stream: Callable[[], AsyncIterator[str]]) -> None:
+    """Reply to the user with an LLM answer, streamed chunk by chunk if streaming is enabled."""
+    if bot.get_property(STREAMING_ENABLED):
+        text = await timed(latency, step, stream_reply(websocket_platform, session, first_chunk_timed(latency, step, stream())))
+        record_message(session, text, False)
+    else:
+        await asyncio.to_thread(reply, session, await timed(latency, step, generate()))
+
+async def extract_abc_information(session: Session, latency: dict, answer: bool = False):
+    """Extract ABC (Activating Event, Belief, Consequence) information from the user message and merge it into the structured data.
+    The answers to the questions of the bot are extracted even if they are short."""
+    cbt_struct_data: CBTData = session.get('cbt_struct_data')
     if cbt_struct_data is None:
-        cbt_struct_data = "[]"
-    response = llm.combine_abc_information(abc_json=cbt_struct_data, input=json.dumps(response, indent = 4))
-    print(response, 'response after combine:', len(response))
-    session.set('cbt_struct_data', response)
+        cbt_struct_data = CBTData()
+        session.set('cbt_struct_data', cbt_struct_data)
+    if extraction_filter.skip(session.message, answer):
+        return
+
+    response = await timed(latency, 'extract', llm.aextract_abc_information(
+        session.message, missing=cbt_struct_data.missing_summary(bot.get_property(ABC_CONTEXT_MAX_RECORDS))))
+    previous_records = cbt_struct_data.records
+    with telemetry.span('step', 'merge') as span:
+        # The similarity of the texts is computed in a thread, so the shared event loop is not blocked
+        conflicts = await asyncio.to_thread(cbt_struct_data.merge, response, bot.get_property(ABC_MERGE_SIMILARITY))
+        span.set(extracted=len(response), records=len(cbt_struct_data.records), conflicts=len(conflicts))
+    if conflicts and bot.get_property(ABC_LLM_CONFLICT_RESOLUTION) and not session.get('token_usage').over_budget:
+        # Only contradicting fields are worth an LLM round-trip (unless the session is over its token budget), and only
+        # the contradicting records are sent to it; its answer replaces them only if it is valid ABC data
+        previous_json = json.dumps([previous_records[index].to_dict() for index in conflicts
+                                    if index < len(previous_records)])
+        combined = await timed(latency, 'combine', llm.acombine_abc_information(
+            abc_json=previous_json, input=json.dumps(response, indent = 4)))
+        records = parse_abc_information(combined)
+        if records is not None:
+            cbt_struct_data.replace(conflicts, records)
+    logging.debug(f"ABC data of session {session.id}: {cbt_struct_data.json}")
 
 def bad_situation_body(session: Session):
     """Bad situation state body to be executed when the user has selected that he had a bad situation."""
     cbt_struct_data = None
     session.set('cbt_struct_data', cbt_struct_data)
 
-    session.reply(bot_messages.bad_situation.value)
-    memory: ConversationBufferMemory = session.get('bot_memory')
+    reply(session, bot_messages.bad_situation.value)
+    memory: 'SessionMemory' = session.get('bot_memory')
     memory.chat_memory.add_user_message(bot_messages.bad_situation.value)
 
 def has_correct_format(session: Session):
-    """Check if the cbt_struct_data has the correct format with inforamtion extracted from the chat conversation."""
-    if session.get('cbt_struct_data') is None:
-        return False
-    
-    cbt_struct_data: str = session.get('cbt_struct_data')
-    cbt_struct_data = json.loads(cbt_struct_data)
-    print("has_correct_format", cbt_struct_data)
-    if not isinstance(cbt_struct_data, list):
-        cbt_struct_data = None
-        session.set('cbt_struct_data', cbt_struct_data)
-        return False
-    
-    return True
+    """Check if the cbt_struct_data has been extracted from the chat conversation."""
+    return session.get('cbt_struct_data') is not None
 
 def check_cbt_data(session: Session, event_params: dict):  
-    """Check if the cbt_struct_data in json requires to be completed by asking further questions."""
+    """Check if the cbt_struct_data requires to be completed by asking further questions."""
     if not has_correct_format(session):
         return True
     
-    cbt_struct_data: str = session.get('cbt_struct_data')
-    cbt_struct_data = json.loads(cbt_struct_data)
-    print("check_cbt_json", cbt_struct_data)
-
-    for s in cbt_struct_data:
-        if s["beliefs_in_event"] == "":
-            return True
-    return False
+    cbt_struct_data: CBTData = session.get('cbt_struct_data')
+    return cbt_struct_data.missing_beliefs
 
-bad_situation_state.set_body(bad_situation_body)
+bad_situation_state.set_body(state_body(bad_situation_body))
 bad_situation_state.when_intent_matched_go_to(end_cbt_intent, end_cbt_state)
 bad_situation_state.when_event_go_to(check_cbt_data, question_state, event_params={})
 
 
 def question_body(session: Session):
     """Question state body to be executed when the structured data is still incomplete."""
-    extract_abc_information(session)
-    response = llm.belief_questions(session.message)
+    memory: 'SessionMemory' = session.get('bot_memory')
 
-    session.reply(response)
+    async def turn(latency: dict):
+        # The follow-up questions only depend on the chat memory, so they are generated while the ABC data is extracted
+        await asyncio.gather(
+            extract_abc_information(session, latency, answer=True),
+            reply_llm(session, latency, 'belief_questions',
+                      lambda: llm.abelief_questions(memory=memory, input=session.message),
+                      lambda: llm.astream_belief_questions(memory=memory, input=session.message)),
+        )
+
+    run_turn(session, turn)
 
 def is_cbt_data_complete(session: Session, event_params: dict):
-    """Check if the cbt_struct_data in json is complete to generate a recommendation."""
+    """Check if the cbt_struct_data is complete to generate a recommendation."""
     if not has_correct_format(session):
         return False
     
-    cbt_struct_data: str = session.get('cbt_struct_data')
-    cbt_struct_data = json.loads(cbt_struct_data)
-    print("is_cbt_complete", cbt_struct_data)
-
-    for s in cbt_struct_data:
-        if "" in s.values():
-            return False
-    
-    return True
+    cbt_struct_data: CBTData = session.get('cbt_struct_data')
+    return cbt_struct_data.complete
 
 def is_cbt_data_incomplete(session: Session, event_params: dict):
-    """Check if the cbt_struct_data in json is incomplete to request more information from the user."""
+    """Check if the cbt_struct_data is incomplete to request more information from the user."""
     return not is_cbt_data_complete(session, event_params)
 
-question_state.set_body(question_body)
+question_state.set_body(state_body(question_body))
 question_state.when_intent_matched_go_to(end_cbt_intent, end_cbt_state)
 question_state.when_event_go_to(is_cbt_data_complete, recommendation_state, event_params={})
 question_state.when_event_go_to(is_cbt_data_incomplete, incomplete_state, event_params={})
@@ -190,37 +442,65 @@ question_state.when_event_go_to(is_cbt_data_incomplete, incomplete_state, event_
 
 def incomplete_body(session: Session):
     """Incomplete state body to be executed when the structured data is still incomplete."""
-    extract_abc_information(session)
-    cbt_struct_data: str = session.get('cbt_struct_data')
-    response = llm.complete_questions(abc_json=cbt_struct_data, input=session.message)
-    session.reply(response)
+    memory: 'SessionMemory' = session.get('bot_memory')
+
+    async def turn(latency: dict):
+        await extract_abc_information(session, latency, answer=True)
+        cbt_struct_data: CBTData = session.get('cbt_struct_data')
+        await reply_llm(session, latency, 'complete_questions',
+                        lambda: llm.acomplete_questions(memory=memory, abc_json=cbt_struct_data.json, input=session.message),
+                        lambda: llm.astream_complete_questions(memory=memory, abc_json=cbt_struct_data.json, input=session.message))
+
+    run_turn(session, turn)
 
 
-incomplete_state.set_body(incomplete_body)
+incomplete_state.set_body(state_body(incomplete_body))
 incomplete_state.when_intent_matched_go_to(end_cbt_intent, end_cbt_state)
 incomplete_state.when_event_go_to(is_cbt_data_complete, recommendation_state, event_params={})
 incomplete_state.when_event_go_to(is_cbt_data_incomplete, question_state, event_params={})
 
 
+async def reply_recommendation(session: Session, latency: dict, memory: 'SessionMemory', cbt_struct_data: CBTData):
+    """Reply with the counterarguments to the beliefs of the user: from the recommendation library, personalized by a
+    short LLM call, when all the beliefs match a known distortion, or generated by the LLM otherwise. The templates of
+    the library are never sent as they are."""
+    start = time.perf_counter()
+    recommendation = None if recommendation_library is None else recommendation_library.recommend(cbt_struct_data.records)
+    if recommendation is None:
+        await reply_llm(session, latency, 'counterarguments',
+                        lambda: llm.acounterarguments_for_fallacies(memory=memory, input=cbt_struct_data.json),
+                        lambda: llm.astream_counterarguments_for_fallacies(memory=memory, input=cbt_struct_data.json))
+    else:
+        await reply_llm(session, latency, 'personalize',
+                        lambda: llm.apersonalize_counterarguments(memory=memory, abc_json=cbt_struct_data.json,
+                                                                  counterarguments=recommendation),
+                        lambda: llm.astream_personalize_counterarguments(memory=memory, abc_json=cbt_struct_data.json,
+                                                                         counterarguments=recommendation))
+    if recommendation_library is not None:
+        recommendation_library.record(hit=recommendation is not None, seconds=time.perf_counter() - start)
+
 def recommendation_body(session: Session):
     """Recommendation state body to be executed when the structured data is complete."""
-    extract_abc_information(session)
-    cbt_struct_data: str = session.get('cbt_struct_data')
-    response = llm.counterarguments_for_fallacies(cbt_struct_data)
-    session.reply(response)
-    session.reply(bot_messages.end_recommendation.value)
+    memory: 'SessionMemory' = session.get('bot_memory')
+
+    async def turn(latency: dict):
+        await extract_abc_information(session, latency, answer=True)
+        await reply_recommendation(session, latency, memory, session.get('cbt_struct_data'))
+
+    run_turn(session, turn)
+    reply(session, bot_messages.end_recommendation.value)
     websocket_platform.reply_options(session, bot_messages.end_options.value)
 
-recommendation_state.set_body(recommendation_body)
+recommendation_state.set_body(state_body(recommendation_body))
 recommendation_state.when_intent_matched_go_to(end_cbt_intent,end_cbt_state)
 recommendation_state.when_intent_matched_go_to(bad_situation_intent,question_state)
 
 
 def end_cbt_body(session: Session):
     """End_CBT state body to be executed when the user has selected that he does not need more help."""
-    session.reply(bot_messages.end_cbt.value)
+    reply(session, bot_messages.end_cbt.value)
 
-end_cbt_state.set_body(end_cbt_body)
+end_cbt_state.set_body(state_body(end_cbt_body))
 end_cbt_state.go_to(initial_state)
 
 
@@ -228,13 +508,13 @@ end_cbt_state.go_to(initial_state)
 def fallback_body(session: Session):
     """Fallback state body to be executed when the bot does not understand the user message.
     It has a reminder of the bot purpose and a default message to be sent to the user."""
-    extract_abc_information(session)
-    session.reply(bot_messages.fallback.value)
-    memory: ConversationBufferMemory = session.get('bot_memory')
+    run_turn(session, lambda latency: extract_abc_information(session, latency))
+    reply(session, bot_messages.fallback.value)
+    memory: 'SessionMemory' = session.get('bot_memory')
     memory.chat_memory.add_user_message(bot_messages.fallback.value)
 
 
-bot.set_global_fallback_body(fallback_body)
+bot.set_global_fallback_body(state_body(fallback_body))
 
 
 if __name__ == '__main__':
@@ -244,7 +524,12 @@ if __name__ == '__main__':
             return s.connect_ex((os.environ['WEBSOCKET_HOST'], port)) == 0
 
     if not is_port_in_use(int(os.environ['WEBSOCKET_PORT'])):
-        bot.run()
+        # Create the LLM client while the bot trains and starts listening, instead of in the first user turn
+        threading.Thread(target=llm.load, name='llm_warm_up', daemon=True).start()
+        if bot.get_property(TELEMETRY_EXPORTER_PORT):
+            telemetry.start_exporter(os.environ['WEBSOCKET_HOST'], bot.get_property(TELEMETRY_EXPORTER_PORT))
+        train_bot(bot)
+        bot.run(train=False)
     else: 
         sys.exit(1)
 
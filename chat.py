@@ -1,17 +1,23 @@
 import streamlit as st
 from streamlit.runtime import Runtime
 from streamlit.runtime.app_session import AppSession
-from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 from streamlit.web import cli as stcli
 from besser.bot.platforms.payload import Payload, PayloadAction, PayloadEncoder
+from session_store import TRANSCRIPT_ACTION
+from multiplexing import CLOSE_ACTION, MESSAGE_ACTION, OPEN_ACTION, envelope
+from streaming import STREAM_ACTION
+from typing import Callable
 
 import queue   
 import json
+import logging
 import time
 import sys
+import socket
 import websocket
 import threading
-import signal
+import uuid
 from dotenv import load_dotenv, find_dotenv
 
 import os
@@ -33,56 +39,230 @@ st.sidebar.markdown(
 )
 
 SESSION_MONITORING_INTERVAL = 10
+BOT_SERVER_READY_TIMEOUT = 120
+BOT_SERVER_RESTART_DELAY = 1
+# A bot server crashing repeatedly (e.g. on startup) is restarted with an exponential backoff, up to a limit
+BOT_SERVER_MAX_RESTART_DELAY = 60
+BOT_SERVER_MAX_RESTARTS = 10
+# Seconds a bot server must run to reset the backoff
+BOT_SERVER_STABLE_TIME = 60
+# Websocket connections to the bot server, shared by all the UI sessions, and seconds between two reconnection attempts
+BOT_CLIENT_CONNECTIONS = 4
+BOT_CLIENT_RECONNECT_DELAY = 2
+# Minimum seconds between two script reruns for the chunks of a streamed reply (its last chunk always reruns it)
+STREAM_RERUN_INTERVAL = 0.2
+# Path of the bot script, so the UI starts it without importing it (and its NLP and LLM dependencies)
+BOT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cbt.py')
+
+
+def is_port_in_use(host: str, port: int) -> bool:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        return s.connect_ex((host, port)) == 0
+
+
+class BotServer:
+    """The bot server process shared by all the UI sessions. A supervisor thread starts it and restarts it if it exits,
+    backing off while it keeps failing quickly."""
+
+    def __init__(self, job: list[str], host: str, port: int):
+        self._job = job
+        self._host = host
+        self._port = port
+        self._process: subprocess.Popen = None
+
+    def start(self):
+        thread = threading.Thread(name='WS Server supervisor', target=self._supervise, daemon=True)
+        thread.start()
 
-def get_streamlit_session() -> AppSession or None:
-    session_id = get_script_run_ctx().session_id
-    runtime: Runtime = Runtime.instance()
-    return next((
-        s.session
-        for s in runtime._session_mgr.list_sessions()
-        if s.session.id == session_id
-    ), None)
-
-def session_monitoring(interval: int):
-    runtime: Runtime = Runtime.instance()
-    session = get_streamlit_session()
-    while True:
-        time.sleep(interval)
-        if not runtime.is_active_session(session.id):
-            runtime.close_session(session.id)
-            session.session_state['websocket'].close()
-            break
+    def _supervise(self):
+        failures = 0
+        while True:
+            if is_port_in_use(self._host, self._port):
+                # A bot server not started by this UI (e.g. run manually) is already serving
+                time.sleep(BOT_SERVER_RESTART_DELAY)
+                continue
+            logging.info(f'Running job: {self._job}')
+            started = time.monotonic()
+            self._process = subprocess.Popen(self._job)
+            self._process.wait()
+            failures = 0 if time.monotonic() - started >= BOT_SERVER_STABLE_TIME else failures + 1
+            if failures > BOT_SERVER_MAX_RESTARTS:
+                logging.error(f'Bot server exited with code {self._process.returncode} after {failures} quick failures '
+                              f'in a row. It will not be restarted')
+                return
+            delay = min(BOT_SERVER_MAX_RESTART_DELAY, BOT_SERVER_RESTART_DELAY * 2 ** max(failures - 1, 0))
+            logging.warning(f'Bot server exited with code {self._process.returncode}, restarting it in {delay}s')
+            time.sleep(delay)
+
+    def wait_ready(self, timeout: float) -> bool:
+        """Readiness probe: wait until the bot server accepts websocket connections."""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if is_port_in_use(self._host, self._port):
+                return True
+            time.sleep(0.1)
+        return False
+
+
+class BotChannel:
+    """A UI session multiplexed over a connection of the bot client pool. It is used as a websocket connection: its
+    `send` sends a payload of the UI session to the bot."""
+
+    def __init__(self, connection: 'BotConnection', channel: str, resume_key: str, on_message: Callable):
+        self.connection = connection
+        self.channel = channel
+        self.resume_key = resume_key
+        self.on_message = on_message
+
+    def send(self, payload_str: str):
+        self.connection.ws.send(envelope(self.channel, MESSAGE_ACTION, message=payload_str))
+
+
+class BotConnection:
+    """A websocket connection to the shared bot server, carrying the channels of several UI sessions. It reconnects
+    if the bot server restarts, opening its channels again (the bot resumes their conversations from its session
+    store)."""
+
+    def __init__(self, url: str):
+        self.channels: dict[str, BotChannel] = {}
+        self._connected = False
+        self._lock = threading.Lock()
+        self.ws = websocket.WebSocketApp(url, on_open=self._on_open, on_message=self._on_message,
+                                         on_close=self._on_close)
+        threading.Thread(target=self.ws.run_forever, kwargs={'reconnect': BOT_CLIENT_RECONNECT_DELAY},
+                         name='bot_connection', daemon=True).start()
+
+    def _open(self, channel: BotChannel):
+        self.ws.send(envelope(channel.channel, OPEN_ACTION, resume_key=channel.resume_key))
+
+    def _on_open(self, ws):
+        with self._lock:
+            self._connected = True
+            for channel in self.channels.values():
+                self._open(channel)
+
+    def _on_close(self, ws, close_status_code, close_msg):
+        with self._lock:
+            self._connected = False
+
+    def _on_message(self, ws, envelope_str):
+        message = json.loads(envelope_str)
+        channel = self.channels.get(message['channel'])
+        if channel is not None:
+            channel.on_message(channel, message['message'])
+
+    def add(self, channel: BotChannel):
+        with self._lock:
+            self.channels[channel.channel] = channel
+            if self._connected:
+                self._open(channel)
+
+    def remove(self, channel: BotChannel):
+        with self._lock:
+            self.channels.pop(channel.channel, None)
+            if self._connected:
+                self.ws.send(envelope(channel.channel, CLOSE_ACTION))
+
+
+class BotClientPool:
+    """The UI sessions multiplexed over a bounded set of websocket connections to the shared bot server, by Streamlit
+    session id.
+
+    Every UI session is a channel of the connection with the fewest channels: the messages carry the id of their
+    channel, and the bot keeps a conversation per channel. The channels survive the script reruns, and they carry the
+    key of the conversation in the bot session store, so it is resumed after a page reload or a bot restart.
+    """
 
-def main():
+    def __init__(self, url: str, size: int):
+        self._url = url
+        self._size = size
+        self._connections: list[BotConnection] = []
+        self._channels: dict[str, BotChannel] = {}
+        self._lock = threading.Lock()
+
+    def start_reaper(self, interval: float):
+        """Start the thread that closes the channels (and the Streamlit sessions) of the closed browser tabs. A
+        single thread checks all the sessions, instead of one per session."""
+        threading.Thread(target=self._reap_forever, args=(interval,), name='session_reaper', daemon=True).start()
+
+    def _reap_forever(self, interval: float):
+        runtime: Runtime = Runtime.instance()
+        while True:
+            time.sleep(interval)
+            with self._lock:
+                session_ids = list(self._channels)
+            for session_id in session_ids:
+                if not runtime.is_active_session(session_id):
+                    runtime.close_session(session_id)
+                    self.close(session_id)
+
+    def connect(self, session_id: str, resume_key: str, on_message: Callable) -> BotChannel:
+        with self._lock:
+            channel = self._channels.get(session_id)
+            if channel is not None:
+                return channel
+            if len(self._connections) < self._size:
+                self._connections.append(BotConnection(self._url))
+            connection = min(self._connections, key=lambda connection: len(connection.channels))
+            channel = BotChannel(connection, session_id, resume_key, on_message)
+            connection.add(channel)
+            self._channels[session_id] = channel
+            return channel
+
+    def close(self, session_id: str):
+        with self._lock:
+            channel = self._channels.pop(session_id, None)
+        if channel is not None:
+            try:
+                channel.connection.remove(channel)
+            except websocket.WebSocketException:
+                pass
 
-    if 'ws_started' not in st.session_state:
-        st.session_state.ws_started = False
-        
-    def start_ws():
-        if st.session_state.ws_started:
-            return
 
-        def _run(job):
-            print (f'\nRunning job: {job}\n')
-            try:
-                proc = subprocess.Popen(job)
-                proc.wait()
-            except subprocess.CalledProcessError as e:
-                print('Subprocess error')
-                os.killpg(os.getpgid(proc.pid), signal.SIGTERM) 
-            return proc
+@st.cache_resource
+def get_bot_server() -> BotServer:
+    """Start the bot server once per Streamlit process. All the UI sessions share it."""
+    server = BotServer([f'{sys.executable}', BOT_SCRIPT],
+                       os.environ['WEBSOCKET_HOST'], int(os.environ['WEBSOCKET_PORT']))
+    server.start()
+    return server
 
-        job = [f'{sys.executable}', os.path.abspath(inspect.getfile(cbt))]
 
-        # server thread will remain active as long as streamlit thread is running, or is manually shutdown
-        thread = threading.Thread(name='WS Server', target=_run, args=(job,), daemon=False)
-        thread.start()
-        st.session_state.ws_started = True
-        time.sleep(5)
-        
-        
+@st.cache_resource
+def get_bot_client_pool() -> BotClientPool:
+    pool = BotClientPool(f"ws://{os.environ['WEBSOCKET_HOST']}:{os.environ['WEBSOCKET_PORT']}/", BOT_CLIENT_CONNECTIONS)
+    pool.start_reaper(SESSION_MONITORING_INTERVAL)
+    return pool
+
+
+def get_streamlit_session() -> AppSession or None:
+    """The Streamlit session of the running script, looked up by its id."""
+    session_info = Runtime.instance()._session_mgr.get_session_info(get_script_run_ctx().session_id)
+    return None if session_info is None else session_info.session
+
+def main():
+    # Looked up once per script run; the websocket callbacks of this session use it for all the bot messages
+    streamlit_session = get_streamlit_session()
+    last_stream_rerun = 0.0
+
     def on_message(ws, payload_str):
-        streamlit_session = get_streamlit_session()
+        nonlocal last_stream_rerun
+        payload_dict = json.loads(payload_str)
+        if payload_dict['action'] == TRANSCRIPT_ACTION:
+            # The transcript of a resumed conversation (e.g. after a page reload): a list of [message, is_user] pairs
+            streamlit_session._session_state['queue'].put(tuple((message, int(is_user))
+                                                                for message, is_user in payload_dict['message']))
+            streamlit_session._handle_rerun_script_request()
+            return
+        if payload_dict['action'] == STREAM_ACTION:
+            # A chunk of a streamed reply: a dict with the reply 'id', the 'chunk' text and whether it is 'done'.
+            # The reruns are coalesced, so the script does not run once per token
+            streamlit_session._session_state['queue'].put(payload_dict['message'])
+            now = time.monotonic()
+            if payload_dict['message']['done'] or now - last_stream_rerun >= STREAM_RERUN_INTERVAL:
+                last_stream_rerun = now
+                streamlit_session._handle_rerun_script_request()
+            return
         payload: Payload = Payload.decode(payload_str)
         if payload.action == PayloadAction.BOT_REPLY_STR.value:
             message = payload.message
@@ -97,21 +277,6 @@ def main():
         streamlit_session._handle_rerun_script_request()
 
 
-    def on_error(ws, error):
-        pass
-
-    def on_open(ws):
-        pass
-
-    def on_close(ws, close_status_code, close_msg):
-        pass
-
-    def on_ping(ws, data):
-        pass
-
-    def on_pong(ws, data):
-        pass
-
     user_type = {
         0: 'assistant',
         1: 'user'
@@ -123,27 +288,22 @@ def main():
     if 'queue' not in st.session_state:
         st.session_state['queue'] = queue.Queue()
 
+    if 'streams' not in st.session_state:
+        st.session_state['streams'] = {}
+
     if 'websocket' not in st.session_state:
-        start_ws()
-        ws = websocket.WebSocketApp(F"ws://{os.environ['WEBSOCKET_HOST']}:{os.environ['WEBSOCKET_PORT']}/",
-                                    on_open=on_open,
-                                    on_message=on_message,
-                                    on_error=on_error,
-                                    on_close=on_close,
-                                    on_ping=on_ping,
-                                    on_pong=on_pong)
-        websocket_thread = threading.Thread(target=ws.run_forever)
-        add_script_run_ctx(websocket_thread)
-        websocket_thread.start()
+        if not get_bot_server().wait_ready(BOT_SERVER_READY_TIMEOUT):
+            st.error('The bot server is not available. Please reload the page.')
+            st.stop()
+        # The key of the conversation is kept in the page URL, so a reload resumes it (and shows its transcript again).
+        # It is the only credential of the stored conversation: anyone with the URL can read it
+        if 'session' not in st.query_params:
+            st.query_params['session'] = str(uuid.uuid4())
+        ws = get_bot_client_pool().connect(get_script_run_ctx().session_id,
+                                           resume_key=st.query_params['session'],
+                                           on_message=on_message)
         st.session_state['websocket'] = ws
 
-    if 'session_monitoring' not in st.session_state:
-        session_monitoring_thread = threading.Thread(target=session_monitoring,
-                                                     kwargs={'interval': SESSION_MONITORING_INTERVAL})
-        add_script_run_ctx(session_monitoring_thread)
-        session_monitoring_thread.start()
-        st.session_state['session_monitoring'] = session_monitoring_thread
-
     ws = st.session_state['websocket']
 
     with st.sidebar:
@@ -151,6 +311,7 @@ def main():
         if reset_button:
             st.session_state['history'] = []
             st.session_state['queue'] = queue.Queue()
+            st.session_state['streams'] = {}
             payload = Payload(action=PayloadAction.RESET)
             ws.send(json.dumps(payload, cls=PayloadEncoder))
 
@@ -158,24 +319,36 @@ def main():
         with st.chat_message(user_type[message[1]]):
             st.write(message[0])
 
-    first_message = True
+    # The messages are rendered as soon as they arrive (every bot message requests a rerun), without simulating the
+    # typing time, so a script run never blocks
     while not st.session_state['queue'].empty():
         message = st.session_state['queue'].get()
-        t = len(message) / 1000 * 3
-        if t > 3:
-            t = 3
-        elif t < 1 and first_message:
-            t = 1
-        first_message = False
-        if isinstance(message, list):
+        if isinstance(message, dict):
+            # A chunk of a streamed reply
+            streams = st.session_state['streams']
+            streams[message['id']] = streams.get(message['id'], '') + message['chunk']
+            if message['done']:
+                reply = streams.pop(message['id'])
+                st.session_state['history'].append((reply, 0))
+                with st.chat_message("assistant"):
+                    st.write(reply)
+        elif isinstance(message, tuple):
+            # The transcript of a resumed conversation replaces the (empty) history of the new UI session
+            st.session_state['history'] = list(message)
+            for text, user in message:
+                with st.chat_message(user_type[user]):
+                    st.write(text)
+        elif isinstance(message, list):
             st.session_state['buttons'] = message
         else:
             st.session_state['history'].append((message, 0))
             with st.chat_message("assistant"):
-                with st.spinner(''):
-                    time.sleep(t)
                 st.write(message)
 
+    for reply in st.session_state['streams'].values():
+        with st.chat_message("assistant"):
+            st.write(reply)
+
     if 'buttons' in st.session_state:
         buttons = st.session_state['buttons']
         cols = st.columns(1)
@@ -205,10 +378,7 @@ def main():
 
     st.stop()
 
-import inspect
-import os
 import subprocess
-import cbt
 
 if __name__ == "__main__":
     if st.runtime.exists():
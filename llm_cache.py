@@ -0,0 +1,164 @@
+from besser.bot.core.property import Property
+from collections import OrderedDict
+from typing import Any
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+SECTION_LLM_CACHE = 'llm_cache'
+
+LLM_CACHE_BACKEND = Property(SECTION_LLM_CACHE, 'llm_cache.backend', str, 'memory')
+"""Where to store the cached LLM responses: 'memory' (in-process), 'sqlite' (local file) or 'none' (disabled)."""
+
+LLM_CACHE_MAX_ENTRIES = Property(SECTION_LLM_CACHE, 'llm_cache.max_entries', int, 1024)
+"""Maximum number of cached responses. The least recently used ones are evicted first."""
+
+LLM_CACHE_TTL = Property(SECTION_LLM_CACHE, 'llm_cache.ttl', int, 3600)
+"""Seconds a cached response is valid."""
+
+LLM_CACHE_SQLITE_PATH = Property(SECTION_LLM_CACHE, 'llm_cache.sqlite_path', str, '.cache/llm_cache.sqlite')
+"""Path of the database file of the 'sqlite' backend."""
+
+LLM_CACHE_GENERATIVE = Property(SECTION_LLM_CACHE, 'llm_cache.cache_generative', bool, False)
+"""Whether to also cache the calls that depend on the chat memory (questions and counterarguments)."""
+
+
+def normalize_prompt(text: str) -> str:
+    """Case and whitespace insensitive version of a prompt text."""
+    return " ".join(text.split()).casefold()
+
+
+class MemoryCacheBackend:
+    """In-process cache backend with LRU and TTL eviction."""
+
+    blocking = False
+    """Whether its lookups block on I/O."""
+
+    def __init__(self, max_entries: int, ttl: int):
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._entries: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> str or None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            created, value = entry
+            if time.time() - created > self._ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: str) -> None:
+        with self._lock:
+            self._entries[key] = (time.time(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+
+class SQLiteCacheBackend:
+    """Local SQLite cache backend with LRU and TTL eviction. It can be shared by several bot processes."""
+
+    blocking = True
+
+    def __init__(self, path: str, max_entries: int, ttl: int):
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS llm_cache "
+                                 "(key TEXT PRIMARY KEY, value TEXT, created REAL, accessed REAL)")
+
+    def get(self, key: str) -> str or None:
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute("SELECT value, created FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if now - row[1] > self._ttl:
+                self._connection.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                return None
+            self._connection.execute("UPDATE llm_cache SET accessed = ? WHERE key = ?", (now, key))
+            return row[0]
+
+    def set(self, key: str, value: str) -> None:
+        now = time.time()
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO llm_cache VALUES (?, ?, ?, ?)", (key, value, now, now))
+            self._connection.execute("DELETE FROM llm_cache WHERE key NOT IN "
+                                     "(SELECT key FROM llm_cache ORDER BY accessed DESC LIMIT ?)", (self._max_entries,))
+
+
+class ResponseCache:
+    """Cache of LLM responses, keyed on the model, the function schema and the normalized prompt.
+
+    Attributes:
+        cache_generative (bool): Whether the calls depending on the chat memory can be cached
+        blocking (bool): Whether the lookups block on I/O, so the async callers must run them in a thread
+        hits (int): Number of lookups answered from the cache
+        misses (int): Number of lookups not found in the cache
+    """
+
+    REPORT_EVERY = 100
+    """Number of lookups between two hit rate log messages."""
+
+    def __init__(self, backend, cache_generative: bool = False):
+        self._backend = backend
+        self.cache_generative = cache_generative
+        self.blocking = getattr(backend, 'blocking', True)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(*parts: Any) -> str:
+        """Content hash of the parts of an LLM call (texts are normalized, other parts are serialized as JSON)."""
+        normalized = [normalize_prompt(part) if isinstance(part, str) else part for part in parts]
+        return hashlib.sha256(json.dumps(normalized, sort_keys=True).encode()).hexdigest()
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hit_rate}
+
+    def get(self, key: str) -> Any:
+        """Get a cached response, or None if it is not cached (or expired)."""
+        value = self._backend.get(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            report = (self.hits + self.misses) % self.REPORT_EVERY == 0
+        if report:
+            logging.info(f"LLM cache hit rate: {self.hit_rate:.1%} ({self.hits} hits, {self.misses} misses)")
+        return None if value is None else json.loads(value)
+
+    def set(self, key: str, value: Any) -> None:
+        self._backend.set(key, json.dumps(value))
+
+
+def create_cache(backend: str, max_entries: int, ttl: int, sqlite_path: str, cache_generative: bool) -> ResponseCache or None:
+    """Create the response cache with the configured backend, or None if the cache is disabled."""
+    if backend == 'memory':
+        return ResponseCache(MemoryCacheBackend(max_entries, ttl), cache_generative)
+    if backend == 'sqlite':
+        return ResponseCache(SQLiteCacheBackend(sqlite_path, max_entries, ttl), cache_generative)
+    if backend != 'none':
+        logging.error(f"Unknown LLM cache backend '{backend}'. The LLM responses will not be cached.")
+    return None
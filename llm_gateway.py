@@ -0,0 +1,223 @@
+from besser.bot.core.property import Property
+from concurrent.futures import Future
+from typing import Any, AsyncIterator, Awaitable, Callable
+
+import asyncio
+import logging
+import random
+import threading
+import time
+
+SECTION_LLM_GATEWAY = 'llm_gateway'
+
+LLM_GATEWAY_RPM = Property(SECTION_LLM_GATEWAY, 'llm_gateway.rpm', int, 0)
+"""Requests per minute allowed by the LLM deployment quota (0 means unlimited)."""
+
+LLM_GATEWAY_TPM = Property(SECTION_LLM_GATEWAY, 'llm_gateway.tpm', int, 0)
+"""Prompt tokens per minute allowed by the LLM deployment quota (0 means unlimited)."""
+
+LLM_GATEWAY_MAX_RETRIES = Property(SECTION_LLM_GATEWAY, 'llm_gateway.max_retries', int, 3)
+"""Number of retries of a request that failed with a rate limit, timeout, connection or server error."""
+
+LLM_GATEWAY_RETRY_BASE_DELAY = Property(SECTION_LLM_GATEWAY, 'llm_gateway.retry_base_delay', float, 0.5)
+"""Seconds to wait before the first retry. The delay doubles on every retry, with random jitter."""
+
+LLM_GATEWAY_RETRY_MAX_DELAY = Property(SECTION_LLM_GATEWAY, 'llm_gateway.retry_max_delay', float, 8.0)
+"""Maximum seconds to wait before a retry."""
+
+LLM_GATEWAY_TIMEOUT = Property(SECTION_LLM_GATEWAY, 'llm_gateway.timeout', float, 30.0)
+"""Deadline of every LLM request (or of the first chunk of a streamed one), in seconds."""
+
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+RETRYABLE_ERRORS = {'APITimeoutError', 'APIConnectionError'}
+
+
+def is_retryable(error: Exception) -> bool:
+    """Whether an LLM request failed with a transient error (rate limit, timeout, connection or server error)."""
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    return getattr(error, 'status_code', None) in RETRYABLE_STATUS_CODES or type(error).__name__ in RETRYABLE_ERRORS
+
+def retry_after(error: Exception) -> float or None:
+    """Seconds to wait requested by the provider in the Retry-After header of an error response, if any."""
+    response = getattr(error, 'response', None)
+    try:
+        return float(response.headers['retry-after'])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """Token bucket refilled continuously at `per_minute` tokens per minute, with a capacity of one minute of tokens.
+
+    Reservations never fail: the bucket goes into debt and the caller waits until the debt is paid, so the requests
+    are spread over time in the order they arrived.
+    """
+
+    def __init__(self, per_minute: int):
+        self._capacity = per_minute
+        self._rate = per_minute / 60
+        self._tokens = float(per_minute)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: int) -> float:
+        """Take tokens from the bucket. Returns the seconds to wait before using them."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+            self._tokens -= min(amount, self._capacity)
+            return max(0.0, -self._tokens / self._rate)
+
+
+class LLMGateway:
+    """Client-side protection of the LLM provider: requests and tokens per minute limits, retries of the transient
+    errors with jittered exponential backoff, request deadlines and de-duplication of identical requests in flight.
+
+    Attributes:
+        timeout (float): Deadline of every request, in seconds
+        requests (int): Number of requests sent to the provider (including retries)
+        retries (int): Number of retried requests
+        coalesced (int): Number of requests answered by an identical request already in flight
+        throttled (float): Total seconds the requests waited for the rate limits
+    """
+
+    def __init__(self, rpm: int, tpm: int, max_retries: int, retry_base_delay: float, retry_max_delay: float,
+                 timeout: float):
+        self._request_bucket = TokenBucket(rpm) if rpm > 0 else None
+        self._token_bucket = TokenBucket(tpm) if tpm > 0 else None
+        self._max_retries = max_retries
+        self._retry_base_delay = retry_base_delay
+        self._retry_max_delay = retry_max_delay
+        self.timeout = timeout
+        self._in_flight: dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.retries = 0
+        self.coalesced = 0
+        self.throttled = 0.0
+
+    def stats(self) -> dict:
+        return {'requests': self.requests, 'retries': self.retries, 'coalesced': self.coalesced,
+                'throttled': self.throttled}
+
+    def _reserve(self, tokens: Callable[[], int]) -> float:
+        """Seconds to wait before sending a request, according to the rate limits."""
+        wait = 0.0
+        if self._request_bucket is not None:
+            wait = self._request_bucket.reserve(1)
+        if self._token_bucket is not None:
+            wait = max(wait, self._token_bucket.reserve(tokens()))
+        with self._lock:
+            self.requests += 1
+            self.throttled += wait
+        return wait
+
+    async def _areserve(self, tokens: Callable[[], int]) -> float:
+        """Async version of _reserve. The tokens are counted in a thread, so the shared event loop is not blocked."""
+        if self._token_bucket is None:
+            return self._reserve(tokens)
+        return await asyncio.to_thread(self._reserve, tokens)
+
+    def _retry_delay(self, attempt: int, error: Exception) -> float or None:
+        """Seconds to wait before retrying a failed request, or None if it must not be retried."""
+        if attempt >= self._max_retries or not is_retryable(error):
+            return None
+        with self._lock:
+            self.retries += 1
+        delay = retry_after(error)
+        if delay is None:
+            delay = min(self._retry_max_delay, self._retry_base_delay * 2 ** attempt)
+            delay = delay / 2 + random.uniform(0, delay / 2)
+        logging.warning(f"LLM request failed ({type(error).__name__}: {error}). Retrying in {delay:.2f}s")
+        return delay
+
+    def _join(self, key: str or None) -> tuple[Future or None, bool]:
+        """The future of the request with the same key in flight (and False), or a new one to complete (and True)."""
+        if key is None:
+            return None, True
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future, False
+            future = self._in_flight[key] = Future()
+            return future, True
+
+    def _leave(self, key: str or None, future: Future or None, result: Any = None, error: BaseException = None) -> None:
+        if future is None:
+            return
+        with self._lock:
+            del self._in_flight[key]
+        if error is None:
+            future.set_result(result)
+        else:
+            future.set_exception(error)
+
+    def call(self, key: str or None, tokens: Callable[[], int], request: Callable[[], Any]) -> Any:
+        """Send a request (retrying it if needed), or wait for the identical one in flight with the same key.
+        The deadline of the synchronous requests is the timeout of the LLM client."""
+        future, owner = self._join(key)
+        if not owner:
+            return future.result()
+        try:
+            for attempt in range(self._max_retries + 1):
+                time.sleep(self._reserve(tokens))
+                try:
+                    result = request()
+                    break
+                except Exception as e:
+                    delay = self._retry_delay(attempt, e)
+                    if delay is None:
+                        raise
+                    time.sleep(delay)
+        except BaseException as e:
+            self._leave(key, future, error=e)
+            raise
+        self._leave(key, future, result=result)
+        return result
+
+    async def acall(self, key: str or None, tokens: Callable[[], int], request: Callable[[], Awaitable]) -> Any:
+        """Async version of call, with a deadline on every attempt."""
+        future, owner = self._join(key)
+        if not owner:
+            return await asyncio.wrap_future(future)
+        try:
+            for attempt in range(self._max_retries + 1):
+                await asyncio.sleep(await self._areserve(tokens))
+                try:
+                    result = await asyncio.wait_for(request(), self.timeout)
+                    break
+                except Exception as e:
+                    delay = self._retry_delay(attempt, e)
+                    if delay is None:
+                        raise
+                    await asyncio.sleep(delay)
+        except BaseException as e:
+            self._leave(key, future, error=e)
+            raise
+        self._leave(key, future, result=result)
+        return result
+
+    async def astream(self, tokens: Callable[[], int], request: Callable[[], AsyncIterator]) -> AsyncIterator:
+        """Stream a request. It is retried (and has a deadline) until its first chunk arrives, as the chunks already
+        sent to the user can not be taken back."""
+        for attempt in range(self._max_retries + 1):
+            await asyncio.sleep(await self._areserve(tokens))
+            chunks = request().__aiter__()
+            try:
+                first = await asyncio.wait_for(chunks.__anext__(), self.timeout)
+                break
+            except StopAsyncIteration:
+                return
+            except Exception as e:
+                await chunks.aclose()
+                delay = self._retry_delay(attempt, e)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+        yield first
+        async for chunk in chunks:
+            yield chunk
+
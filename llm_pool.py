@@ -0,0 +1,204 @@
+from besser.bot.core.property import Property
+from llm_gateway import is_retryable
+from token_usage import over_budget
+from typing import Any, AsyncIterator, Awaitable, Callable
+
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+SECTION_LLM_POOL = 'llm_pool'
+
+LLM_POOL_FILE = Property(SECTION_LLM_POOL, 'llm_pool.file', str, '')
+"""JSON file with the LLM deployments to balance the requests between (see load_backend_specs). If empty, the bot uses
+the single deployment set by the OPENAI_API_TYPE environment variable."""
+
+LLM_POOL_FAILURE_THRESHOLD = Property(SECTION_LLM_POOL, 'llm_pool.failure_threshold', int, 3)
+"""Number of consecutive failed requests after which a deployment is considered unhealthy."""
+
+LLM_POOL_COOLDOWN = Property(SECTION_LLM_POOL, 'llm_pool.cooldown', float, 30.0)
+"""Seconds an unhealthy deployment receives no requests (unless all the others are unhealthy too)."""
+
+
+class Backend:
+    """An LLM deployment of the pool, with its chains and its health.
+
+    Attributes:
+        name (str): Name of the deployment
+        llm: The chat model of the deployment
+        weight (float): Relative capacity of the deployment. It receives requests in proportion to it
+        prompts (set[str] or None): Names of the prompts it serves (e.g. cheap deployments for EXTRACT), or None for all
+        economy (bool): Whether it is a cheaper deployment, used by the sessions over their token budget
+        outstanding (int): Number of requests in flight
+        failures (int): Number of consecutive failed requests
+        unhealthy_until (float): Monotonic time until which the deployment is unhealthy
+    """
+
+    def __init__(self, name: str, llm, weight: float = 1.0, prompts: list[str] = None, economy: bool = False):
+        self.name = name
+        self.llm = llm
+        self.weight = weight
+        self.prompts = set(prompts) if prompts else None
+        self.economy = economy
+        self.extraction_chain = None
+        self.generation_chain = None
+        self.outstanding = 0
+        self.failures = 0
+        self.unhealthy_until = 0.0
+
+    @property
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.unhealthy_until
+
+    def serves(self, prompt: str) -> bool:
+        return self.prompts is None or prompt in self.prompts
+
+
+class LLMPool:
+    """Weighted pool of LLM deployments. Every request goes to the healthy deployment serving its prompt with the
+    fewest outstanding requests (relative to its weight). If it fails with a transient error, the request fails over
+    to the next deployment. The requests of the sessions over their token budget go to the economy deployments, if
+    any of them serves the prompt."""
+
+    def __init__(self, backends: list[Backend], failure_threshold: int = 3, cooldown: float = 30.0):
+        self.backends = backends
+        self._failure_threshold = failure_threshold
+        self._cooldown = cooldown
+        self._lock = threading.Lock()
+
+    def stats(self) -> dict:
+        return {backend.name: {'outstanding': backend.outstanding, 'failures': backend.failures,
+                               'healthy': backend.healthy} for backend in self.backends}
+
+    def _choose(self, prompt: str, tried: list[Backend]) -> Backend or None:
+        """Take the deployment for the next attempt of a request, or None if all of them were tried."""
+        candidates = [backend for backend in self.backends if backend.serves(prompt)] or self.backends
+        if over_budget():
+            candidates = [backend for backend in candidates if backend.economy] or candidates
+        candidates = [backend for backend in candidates if backend not in tried]
+        if not candidates:
+            return None
+        with self._lock:
+            healthy = [backend for backend in candidates if backend.healthy]
+            if not healthy:
+                healthy = [min(candidates, key=lambda backend: backend.unhealthy_until)]
+            backend = min(healthy, key=lambda backend: ((backend.outstanding + 1) / backend.weight, random.random()))
+            backend.outstanding += 1
+        tried.append(backend)
+        return backend
+
+    def _finish(self, backend: Backend, error: Exception = None) -> None:
+        with self._lock:
+            backend.outstanding -= 1
+            if error is None:
+                backend.failures = 0
+                backend.unhealthy_until = 0.0
+                return
+            backend.failures += 1
+            if backend.failures >= self._failure_threshold:
+                backend.unhealthy_until = time.monotonic() + self._cooldown
+                logging.warning(f"LLM deployment '{backend.name}' is unhealthy after {backend.failures} failed "
+                                f"requests. No requests for {self._cooldown}s")
+
+    def _failover(self, prompt: str, tried: list[Backend], error: Exception) -> Backend:
+        """Record a failed attempt and take the deployment to retry it, or raise the error if it can not be retried."""
+        backend = tried[-1]
+        self._finish(backend, error)
+        next_backend = self._choose(prompt, tried) if is_retryable(error) else None
+        if next_backend is None:
+            raise error
+        logging.warning(f"LLM request failed in '{backend.name}' ({type(error).__name__}). "
+                        f"Failing over to '{next_backend.name}'")
+        return next_backend
+
+    def invoke(self, prompt: str, request: Callable[[Backend], Any]) -> Any:
+        """Send a request for a prompt to the best deployment, failing over to the others."""
+        tried = []
+        backend = self._choose(prompt, tried)
+        while True:
+            try:
+                result = request(backend)
+            except Exception as e:
+                backend = self._failover(prompt, tried, e)
+                continue
+            self._finish(backend)
+            return result
+
+    async def ainvoke(self, prompt: str, request: Callable[[Backend], Awaitable]) -> Any:
+        """Async version of invoke."""
+        tried = []
+        backend = self._choose(prompt, tried)
+        while True:
+            try:
+                result = await request(backend)
+            except Exception as e:
+                backend = self._failover(prompt, tried, e)
+                continue
+            self._finish(backend)
+            return result
+
+    async def astream(self, prompt: str, request: Callable[[Backend], AsyncIterator]) -> AsyncIterator:
+        """Stream a request for a prompt. It fails over to another deployment until its first chunk arrives."""
+        tried = []
+        backend = self._choose(prompt, tried)
+        while True:
+            chunks = request(backend).__aiter__()
+            try:
+                first = await chunks.__anext__()
+                break
+            except StopAsyncIteration:
+                self._finish(backend)
+                return
+            except Exception as e:
+                backend = self._failover(prompt, tried, e)
+        error = None
+        try:
+            yield first
+            async for chunk in chunks:
+                yield chunk
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self._finish(backend, error)
+
+
+def load_backend_specs(path: str) -> list[dict]:
+    """Read the deployments of the pool from a JSON file. It is a list of objects with:
+
+    - name: name of the deployment
+    - type: 'azure' or 'openai'
+    - deployment (azure) or model (openai): the deployed model
+    - endpoint, api_version (azure, optional): they default to the AZURE_OPENAI_ENDPOINT and OPENAI_API_VERSION
+      environment variables
+    - api_key_env (optional): environment variable with the API key (by default, the one of the LangChain client)
+    - weight (optional): relative capacity of the deployment (1 by default)
+    - prompts (optional): names of the prompts it serves (e.g. ["EXTRACT", "COMBINE"]). By default, all of them
+    - economy (optional): whether it is a cheaper deployment for the sessions over their token budget (false by default)
+    """
+    with open(path) as f:
+        return json.load(f)
+
+def create_backend(spec: dict, client_options: dict) -> Backend:
+    """Create the chat model of a deployment of the pool."""
+    options = dict(client_options)
+    if 'api_key_env' in spec:
+        options['api_key'] = os.environ[spec['api_key_env']]
+    if spec['type'] == 'azure':
+        from langchain_openai import AzureChatOpenAI
+        if 'endpoint' in spec:
+            options['azure_endpoint'] = spec['endpoint']
+        if 'api_version' in spec:
+            options['api_version'] = spec['api_version']
+        llm = AzureChatOpenAI(azure_deployment=spec['deployment'], temperature=0, **options)
+    elif spec['type'] == 'openai':
+        from langchain_openai import ChatOpenAI
+        if 'model' in spec:
+            options['model'] = spec['model']
+        llm = ChatOpenAI(temperature=0, stream_usage=True, **options)
+    else:
+        raise ValueError(f"Unknown LLM deployment type '{spec['type']}' of '{spec['name']}'")
+    return Backend(spec['name'], llm, spec.get('weight', 1.0), spec.get('prompts'), spec.get('economy', False))
@@ -0,0 +1,59 @@
+from besser.bot.core.property import Property
+from collections import Counter
+
+import logging
+import re
+import threading
+
+SECTION_EXTRACTION = 'extraction'
+
+EXTRACTION_MIN_WORDS = Property(SECTION_EXTRACTION, 'extraction.min_words', int, 3)
+"""Messages with fewer words are too short to contain ABC information, so they are not sent to the LLM. It does not
+apply to the answers to the questions of the bot, which can be short (e.g. "Got fired.")."""
+
+SMALL_TALK = ['hi', 'hello', 'hey', 'good morning', 'good afternoon', 'good evening', 'bye', 'goodbye',
+              'thanks', 'thank you', 'thank you very much', 'thanks a lot', 'ok', 'okay', 'yes', 'no', 'sure']
+
+
+def normalize_message(message: str) -> str:
+    """Lowercase a message and remove its punctuation and repeated whitespaces."""
+    return " ".join(re.sub(r"[^\w\s]", " ", message.lower()).split())
+
+
+class ExtractionFilter:
+    """Cheap local classifier of the user messages that can never contain ABC information (option buttons, greetings,
+    thanks and very short messages), to skip their LLM extraction.
+
+    Attributes:
+        skipped (Counter): Number of skipped extractions, by reason
+    """
+
+    def __init__(self, options: list[str], small_talk: list[str], min_words: int):
+        self._options = {normalize_message(option) for option in options}
+        self._small_talk = {normalize_message(sentence) for sentence in small_talk}
+        self._min_words = min_words
+        self._lock = threading.Lock()
+        self.skipped = Counter()
+
+    def skip_reason(self, message: str, answer: bool = False) -> str or None:
+        """The reason to skip the extraction of a message, or None if it must be extracted. The answers to the
+        questions of the bot are only skipped if they are options or small talk."""
+        text = normalize_message(message or "")
+        if text in self._options:
+            return 'option'
+        if text in self._small_talk:
+            return 'small_talk'
+        if not answer and len(text.split()) < self._min_words:
+            return 'short'
+        return None
+
+    def skip(self, message: str, answer: bool = False) -> bool:
+        """Check if the extraction of a message can be skipped, counting the avoided LLM calls."""
+        reason = self.skip_reason(message, answer)
+        if reason is None:
+            return False
+        with self._lock:
+            self.skipped[reason] += 1
+            total = sum(self.skipped.values())
+        logging.info(f"Skipped ABC extraction ({reason}). Avoided LLM calls: {total} {dict(self.skipped)}")
+        return True
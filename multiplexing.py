@@ -0,0 +1,121 @@
+from besser.bot.core.file import File
+from besser.bot.platforms.payload import Payload, PayloadAction
+from types import SimpleNamespace
+from typing import TYPE_CHECKING
+from urllib.parse import urlencode
+from websockets.exceptions import ConnectionClosedError
+
+import base64
+import json
+import logging
+import queue
+import threading
+
+if TYPE_CHECKING:
+    from besser.bot.core.bot import Bot
+    from besser.bot.platforms.websocket.websocket_platform import WebSocketPlatform
+
+OPEN_ACTION = 'open'
+"""Envelope action opening a channel. Its 'resume_key' is the key of the conversation in the session store."""
+
+CLOSE_ACTION = 'close'
+"""Envelope action closing a channel (the UI session is gone)."""
+
+MESSAGE_ACTION = 'message'
+"""Envelope action of a payload sent through a channel, in its 'message'."""
+
+
+def envelope(channel: str, action: str, **fields) -> str:
+    """A message of a multiplexed connection: the action of a channel (a UI session) and its fields."""
+    return json.dumps({'channel': channel, 'action': action, **fields})
+
+
+class Channel:
+    """A UI session multiplexed over a shared websocket connection. It stands for a client connection in the websocket
+    platform, so the bot replies to the UI session through it, and it handles the payloads of the UI session in order,
+    in its own thread, so a slow turn never blocks the other sessions of the connection.
+
+    Attributes:
+        id (str): Id of the bot session of the channel
+        request: The request path of the channel, with the key of the conversation in the session store, as in a
+            direct connection
+    """
+
+    def __init__(self, connection, channel: str, resume_key: str or None):
+        self._connection = connection
+        self._channel = channel
+        self._payloads = queue.Queue()
+        self.id = f'{connection.id}/{channel}'
+        self.request = SimpleNamespace(path='/?' + urlencode({'session': resume_key}) if resume_key else '/')
+
+    def send(self, message: str) -> None:
+        self._connection.send(envelope(self._channel, MESSAGE_ACTION, message=message))
+
+    def close_socket(self) -> None:
+        self._connection.close_socket()
+
+    def start(self, platform: 'WebSocketPlatform', bot: 'Bot') -> None:
+        threading.Thread(target=self._run, args=(platform, bot), name=f'channel-{self.id}', daemon=True).start()
+
+    def put(self, payload_str: str) -> None:
+        self._payloads.put(payload_str)
+
+    def close(self) -> None:
+        self._payloads.put(None)
+
+    def _run(self, platform: 'WebSocketPlatform', bot: 'Bot') -> None:
+        platform._connections[self.id] = self
+        session = bot.get_or_create_session(self.id, platform)
+        try:
+            while (payload_str := self._payloads.get()) is not None:
+                try:
+                    handle_payload(bot, session.id, Payload.decode(payload_str))
+                except Exception as _:
+                    logging.exception(f"An error occurred handling a message of session {session.id}")
+        finally:
+            bot.delete_session(session.id)
+            del platform._connections[session.id]
+
+
+def handle_payload(bot: 'Bot', session_id: str, payload: Payload) -> None:
+    """Pass a payload of a UI session to the bot, as the websocket platform does for a direct connection."""
+    if payload.action == PayloadAction.USER_MESSAGE.value:
+        bot.receive_message(session_id, payload.message)
+    elif payload.action == PayloadAction.USER_VOICE.value:
+        audio_bytes = base64.b64decode(payload.message.encode('utf-8'))
+        bot.receive_message(session_id, bot.nlp_engine.speech2text(audio_bytes))
+    elif payload.action == PayloadAction.USER_FILE.value:
+        bot.receive_file(session_id, File.decode(payload.message))
+    elif payload.action == PayloadAction.RESET.value:
+        bot.reset(session_id)
+
+
+def use_multiplexing(platform: 'WebSocketPlatform', bot: 'Bot') -> None:
+    """Make the websocket platform serve multiplexed connections: every message is an envelope of a channel (see
+    envelope), and every channel is a bot session. Call it before running the bot."""
+    def message_handler(connection) -> None:
+        channels: dict[str, Channel] = {}
+        try:
+            for envelope_str in connection:
+                if not platform.running:
+                    break
+                try:
+                    message = json.loads(envelope_str)
+                    channel = channels.get(message['channel'])
+                except (ValueError, KeyError, TypeError):
+                    logging.warning(f"Ignoring a malformed message of connection {connection.id}")
+                    continue
+                if message.get('action') == OPEN_ACTION and channel is None:
+                    channel = Channel(connection, message['channel'], message.get('resume_key'))
+                    channels[message['channel']] = channel
+                    channel.start(platform, bot)
+                elif message.get('action') == CLOSE_ACTION and channel is not None:
+                    channels.pop(message['channel']).close()
+                elif message.get('action') == MESSAGE_ACTION and channel is not None:
+                    channel.put(message.get('message', ''))
+        except ConnectionClosedError:
+            pass
+        finally:
+            for channel in channels.values():
+                channel.close()
+    platform._message_handler = message_handler
@@ -0,0 +1,126 @@
+from besser.bot.core.bot import Bot
+from besser.bot.core.property import Property
+from besser.bot.exceptions.exceptions import InitialStateNotFound
+from besser.bot.nlp import SECTION_NLP
+from besser.bot.nlp.intent_classifier.simple_intent_classifier import SimpleIntentClassifier
+from importlib.metadata import version
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+SECTION_NLP_CACHE = 'nlp_cache'
+
+NLP_CACHE_ENABLED = Property(SECTION_NLP_CACHE, 'nlp_cache.enabled', bool, True)
+"""Whether to reuse the trained intent classifiers of a previous run with the same intents and NLP configuration."""
+
+NLP_CACHE_DIR = Property(SECTION_NLP_CACHE, 'nlp_cache.dir', str, '.cache/nlp')
+"""Directory of the trained NLP artifacts. Bot replicas can share it."""
+
+ARTIFACT_FILE = 'artifact.json'
+
+
+def artifact_key(bot: Bot) -> str:
+    """Content hash of everything the training depends on: the intents and entities, the intent classifier
+    configuration of every state, the NLP properties and the library versions."""
+    content = {
+        'versions': {package: version(package) for package in ('besser-bot-framework', 'keras')},
+        'nlp': dict(bot.config[SECTION_NLP]) if bot.config.has_section(SECTION_NLP) else {},
+        'entities': [{'name': entity.name, 'entries': [[entry.value, entry.synonyms] for entry in entity.entries or []]}
+                     for entity in bot.entities],
+        'states': [{
+            'name': state.name,
+            'ic_config': {name: str(value) for name, value in vars(state.ic_config).items()},
+            'intents': [{
+                'name': intent.name,
+                'training_sentences': intent.training_sentences,
+                'parameters': [[parameter.name, parameter.fragment, parameter.entity.name]
+                               for parameter in intent.parameters],
+            } for intent in state.intents],
+        } for state in bot.states if state.intents],
+    }
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+
+def save_artifact(bot: Bot, path: str) -> None:
+    """Write the trained intent classifiers (tokenizer vocabulary, processed sentences and model weights).
+    The artifact is written to a temporary directory and then renamed, so other replicas never read it half written."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = tempfile.mkdtemp(dir=os.path.dirname(path))
+    artifact = {}
+    for state, intent_classifier in bot.nlp_engine._intent_classifiers.items():
+        artifact[state.name] = {
+            'vocabulary': intent_classifier._tokenizer.get_vocabulary(),
+            'processed_training_sentences': [intent.processed_training_sentences for intent in state.intents],
+        }
+        np.savez(os.path.join(tmp_path, f'{state.name}.npz'), *intent_classifier._model.get_weights())
+    with open(os.path.join(tmp_path, ARTIFACT_FILE), 'w') as f:
+        json.dump(artifact, f)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # Another replica saved the same artifact first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def load_artifact(bot: Bot, path: str) -> None:
+    """Restore the intent classifiers of every state from a saved artifact, instead of training them."""
+    with open(os.path.join(path, ARTIFACT_FILE)) as f:
+        artifact = json.load(f)
+    for state, intent_classifier in bot.nlp_engine._intent_classifiers.items():
+        state_artifact = artifact[state.name]
+        sentences = []
+        labels = []
+        for label, (intent, processed_sentences) in enumerate(zip(state.intents,
+                                                                  state_artifact['processed_training_sentences'])):
+            intent.processed_training_sentences = processed_sentences
+            sentences.extend(processed_sentences)
+            labels.extend([label] * len(processed_sentences))
+        intent_classifier._tokenizer.set_vocabulary(state_artifact['vocabulary'])
+        intent_classifier._model.build(input_shape=(None, state.ic_config.input_max_num_tokens))
+        with np.load(os.path.join(path, f'{state.name}.npz')) as weights:
+            intent_classifier._model.set_weights([weights[f'arr_{i}'] for i in range(len(weights.files))])
+        # Private state of the classifier, used by its exact match check
+        intent_classifier._SimpleIntentClassifier__total_training_sentences = sentences
+        intent_classifier._SimpleIntentClassifier__total_training_sequences = intent_classifier._tokenizer(sentences)
+        intent_classifier._SimpleIntentClassifier__total_labels_training_sentences = labels
+        intent_classifier._SimpleIntentClassifier__intent_label_mapping = dict(enumerate(state.intents))
+
+
+def train_bot(bot: Bot) -> None:
+    """Train the bot like Bot.train, but load the intent classifiers from the NLP cache when an artifact with the same
+    key exists (and save it otherwise). Run the bot afterwards with bot.run(train=False)."""
+    if not bot.get_property(NLP_CACHE_ENABLED):
+        bot.train()
+        return
+    if not bot.initial_state():
+        raise InitialStateNotFound(bot)
+    key = artifact_key(bot)
+    path = os.path.join(bot.get_property(NLP_CACHE_DIR), key)
+    bot._init_global_states()
+    bot.nlp_engine.initialize()
+    cacheable = all(isinstance(intent_classifier, SimpleIntentClassifier)
+                    for intent_classifier in bot.nlp_engine._intent_classifiers.values())
+    if cacheable and os.path.exists(os.path.join(path, ARTIFACT_FILE)):
+        try:
+            bot.nlp_engine.ner.train()
+            load_artifact(bot, path)
+            bot._trained = True
+            logging.info(f'{bot.name} NLP loaded from {path}')
+            return
+        except Exception as e:
+            logging.error(f'The NLP artifact {path} could not be loaded ({e}). Training the bot instead.')
+            bot.nlp_engine._intent_classifiers.clear()
+            bot.nlp_engine.initialize()
+    logging.info(f'{bot.name} training started')
+    bot.nlp_engine.train()
+    logging.info(f'{bot.name} training finished')
+    bot._trained = True
+    if cacheable:
+        save_artifact(bot, path)
+        logging.info(f'{bot.name} NLP saved to {path}')
@@ -0,0 +1,146 @@
+from besser.bot.core.property import Property
+from abc_data import ABCRecord, normalize_text
+from textwrap import shorten
+
+import json
+import logging
+import re
+import threading
+
+SECTION_RECOMMENDATIONS = 'recommendations'
+
+RECOMMENDATIONS_LIBRARY = Property(SECTION_RECOMMENDATIONS, 'recommendations.library', str, 'recommendation_library.json')
+"""JSON file with the vetted counterarguments of common cognitive distortions (see load_distortions). If empty, the
+counterarguments are always generated by the LLM."""
+
+RECOMMENDATIONS_MIN_SCORE = Property(SECTION_RECOMMENDATIONS, 'recommendations.min_score', float, 0.8)
+"""Minimum matching score (0 to 1) between a belief and a distortion to answer it from the library. It must be above
+the weight of every pattern, so a single loose match never selects a counterargument."""
+
+BELIEF_LENGTH = 200
+
+
+class Distortion:
+    """A cognitive distortion of the library, with the patterns of the beliefs showing it and its counterargument.
+
+    Attributes:
+        name (str): Name of the distortion (e.g. catastrophizing)
+        patterns (list[tuple[re.Pattern, float]]): Regular expressions over the normalized belief, with their weights
+        counterargument (str): Vetted counterargument. Its {belief} placeholder is replaced by the belief of the user
+    """
+    __slots__ = ('name', 'patterns', 'counterargument')
+
+    def __init__(self, name: str, patterns: list[tuple[re.Pattern, float]], counterargument: str):
+        self.name = name
+        self.patterns = patterns
+        self.counterargument = counterargument
+
+    def score(self, text: str) -> float:
+        """Matching score (0 to 1) of a normalized belief: the sum of the weights of the matching patterns."""
+        return min(1.0, sum(weight for pattern, weight in self.patterns if pattern.search(text)))
+
+
+class RecommendationLibrary:
+    """Local index of vetted counterarguments by cognitive distortion. The beliefs are matched with cheap regular
+    expressions, so the recommendations of the common distortions don't need a full LLM generation.
+
+    Attributes:
+        hits (int): Number of recommendations answered from the library
+        misses (int): Number of recommendations generated by the LLM
+        library_seconds (float): Total seconds of the recommendations answered from the library
+        llm_seconds (float): Total seconds of the recommendations generated by the LLM
+    """
+
+    REPORT_EVERY = 100
+    """Number of recommendations between two hit rate log messages."""
+
+    def __init__(self, distortions: list[Distortion], min_score: float):
+        self._distortions = distortions
+        self._min_score = min_score
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.library_seconds = 0.0
+        self.llm_seconds = 0.0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    @property
+    def saved_seconds(self) -> float:
+        """Estimated time saved by the library: the mean time of an LLM recommendation minus the one of a library
+        recommendation, for every hit."""
+        if not self.hits or not self.misses:
+            return 0.0
+        return self.hits * (self.llm_seconds / self.misses - self.library_seconds / self.hits)
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hit_rate, 'saved_seconds': self.saved_seconds}
+
+    def match(self, belief: str) -> Distortion or None:
+        """The distortion matching a belief with the best score, or None if no score reaches the minimum."""
+        text = normalize_text(belief)
+        score, distortion = max(((distortion.score(text), distortion) for distortion in self._distortions),
+                                key=lambda match: match[0], default=(0.0, None))
+        return distortion if score >= self._min_score else None
+
+    def recommend(self, records: list[ABCRecord]) -> str or None:
+        """The counterarguments of the beliefs of the records (one paragraph per belief), or None if some belief does
+        not match any distortion confidently."""
+        paragraphs = []
+        for record in records:
+            if not record.beliefs_in_event:
+                continue
+            distortion = self.match(record.beliefs_in_event)
+            if distortion is None:
+                return None
+            paragraphs.append(distortion.counterargument.format(belief=shorten(record.beliefs_in_event, BELIEF_LENGTH)))
+        return "\n\n".join(paragraphs) or None
+
+    def record(self, hit: bool, seconds: float) -> None:
+        """Count a recommendation, answered from the library or not, and its duration."""
+        with self._lock:
+            if hit:
+                self.hits += 1
+                self.library_seconds += seconds
+            else:
+                self.misses += 1
+                self.llm_seconds += seconds
+            report = (self.hits + self.misses) % self.REPORT_EVERY == 0
+        if report:
+            logging.info(f"Recommendation library hit rate: {self.hit_rate:.1%} ({self.hits} hits, {self.misses} "
+                         f"misses), {self.saved_seconds:.1f}s saved")
+
+
+def load_distortions(path: str) -> list[Distortion]:
+    """Read the distortions of the library from a JSON file. It is a list of objects with:
+
+    - distortion: name of the distortion
+    - patterns: list of objects with a regular expression 'pattern' (over the belief in lowercase, without
+      punctuation) and its 'weight' in the matching score
+    - counterargument: the vetted counterargument. It can include the belief of the user with {belief}
+    """
+    with open(path) as f:
+        return [Distortion(distortion['distortion'],
+                           [(re.compile(pattern['pattern']), pattern['weight']) for pattern in distortion['patterns']],
+                           distortion['counterargument'])
+                for distortion in json.load(f)]
+
+def create_recommendation_library(path: str, min_score: float) -> RecommendationLibrary or None:
+    """Create the recommendation library, or None if there is no library file."""
+    if not path:
+        return None
+    try:
+        distortions = load_distortions(path)
+    except (OSError, ValueError, KeyError, re.error) as e:
+        logging.error(f"An error occurred loading the recommendation library '{path}': {e}. "
+                      f"The counterarguments will always be generated by the LLM.")
+        return None
+    for distortion in distortions:
+        for pattern, weight in distortion.patterns:
+            if weight >= min_score:
+                logging.warning(f"The pattern '{pattern.pattern}' of '{distortion.name}' reaches the minimum score of "
+                                f"the recommendation library ({min_score}) alone")
+    return RecommendationLibrary(distortions, min_score)
@@ -0,0 +1,56 @@
+from besser.bot.core.property import Property
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+import contextvars
+
+SECTION_MEMORY = 'memory'
+
+MEMORY_MAX_TOKEN_LIMIT = Property(SECTION_MEMORY, 'memory.max_token_limit', int, 1000)
+"""Maximum number of tokens of the chat history kept verbatim. Older messages are compressed into a summary."""
+
+MEMORY_SUMMARY_WORKERS = Property(SECTION_MEMORY, 'memory.summary_workers', int, 2)
+"""Number of background threads summarizing the chat history of all the sessions."""
+
+_summary_executor: ThreadPoolExecutor = None
+
+
+def start_summary_workers(workers: int) -> None:
+    """Create the thread pool that summarizes the chat history of the sessions in the background."""
+    global _summary_executor
+    _summary_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='memory_summary')
+
+def run_summary(summarize: Callable[[], None]) -> None:
+    """Run a summarization in the background threads, or right away if they have not been started. It runs in the
+    context of the caller, so its LLM call is counted in the token usage of the session."""
+    if _summary_executor is None:
+        summarize()
+    else:
+        _summary_executor.submit(contextvars.copy_context().run, summarize)
+
+def new_session_memory(agent, max_token_limit: int):
+    """Create the chat memory of a session, summarized by the Agent. LangChain is only imported when the first session
+    starts."""
+    from summary_memory import SessionMemory
+    return SessionMemory(agent=agent, max_token_limit=max_token_limit)
+
+
+class MemoryOverlay:
+    """View of a chat memory with transient messages after its history (e.g. the ABC data for a prompt).
+
+    The messages are never added to the memory and its history is not copied, so they don't reach the later prompts
+    nor the session store. The new turns and the rest of the attributes go to the memory itself."""
+
+    def __init__(self, memory, messages: list):
+        self.memory = memory
+        self.messages = messages
+
+    def load_memory_variables(self, inputs: dict) -> dict:
+        variables = self.memory.load_memory_variables(inputs)
+        return {**variables, self.memory.memory_key: variables[self.memory.memory_key] + self.messages}
+
+    def save_context(self, inputs: dict, outputs: dict) -> None:
+        self.memory.save_context(inputs, outputs)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.memory, name)
@@ -0,0 +1,155 @@
+from besser.bot.core.property import Property
+
+import atexit
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+SECTION_SESSION_STORE = 'session_store'
+
+SESSION_STORE_BACKEND = Property(SECTION_SESSION_STORE, 'session_store.backend', str, 'none')
+"""Where to keep the sessions, so they survive restarts and can move between bot replicas: 'sqlite' (local file,
+which several replicas on the same host can share) or 'none' (sessions only live in the bot process). The stored
+sessions include the chat transcript, under the session key sent by the client, for session_store.ttl seconds. That key
+(the 'session' parameter of the page URL) is the only credential of a stored session: anyone with the URL can resume it
+and read its transcript, so the URL must not be shared."""
+
+SESSION_STORE_SQLITE_PATH = Property(SECTION_SESSION_STORE, 'session_store.sqlite_path', str, '.cache/sessions.sqlite')
+"""Path of the database file of the 'sqlite' backend."""
+
+SESSION_STORE_FLUSH_INTERVAL = Property(SECTION_SESSION_STORE, 'session_store.flush_interval', float, 2.0)
+"""Seconds between two writes of the changed sessions to the store."""
+
+SESSION_STORE_TRANSCRIPT_MESSAGES = Property(SECTION_SESSION_STORE, 'session_store.transcript_messages', int, 100)
+"""Number of the latest chat messages kept in a stored session, and shown again to the user when it is resumed (0 to
+not keep them)."""
+
+SESSION_STORE_TTL = Property(SECTION_SESSION_STORE, 'session_store.ttl', int, 86400)
+"""Seconds a session is kept in the store after its last change. Older sessions are never restored, and they are
+deleted periodically."""
+
+TRANSCRIPT_ACTION = 'bot_reply_transcript'
+"""Payload action of the transcript of a resumed session. Its message is a list of [message, is_user] pairs."""
+
+
+def encode_session(snapshot: dict) -> bytes:
+    """Compact form of a session snapshot: compressed JSON."""
+    return zlib.compress(json.dumps(snapshot, separators=(',', ':')).encode())
+
+def decode_session(data: bytes) -> dict:
+    return json.loads(zlib.decompress(data))
+
+
+class SQLiteSessionBackend:
+    """Local SQLite session backend."""
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS sessions (key TEXT PRIMARY KEY, data BLOB, updated REAL)")
+
+    def load(self, key: str, since: float) -> bytes or None:
+        """The data of a session changed after `since`, or None."""
+        with self._lock:
+            row = self._connection.execute("SELECT data FROM sessions WHERE key = ? AND updated >= ?",
+                                           (key, since)).fetchone()
+        return None if row is None else row[0]
+
+    def save_many(self, entries: list[tuple[str, bytes, float]]) -> None:
+        with self._lock:
+            self._connection.execute("BEGIN")
+            self._connection.executemany("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)", entries)
+            self._connection.execute("COMMIT")
+
+    def expire(self, before: float) -> None:
+        with self._lock:
+            self._connection.execute("DELETE FROM sessions WHERE updated < ?", (before,))
+
+
+class SessionStore:
+    """Write-behind store of session snapshots. Saving a snapshot only keeps it in memory; a background thread writes
+    the changed ones to the backend every `flush_interval` seconds (and when the process exits), and deletes the
+    expired ones every EXPIRE_EVERY seconds.
+
+    Attributes:
+        flushed (int): Number of snapshots written to the backend
+        restored (int): Number of sessions loaded from the store
+    """
+
+    EXPIRE_EVERY = 600.0
+    """Seconds between two deletions of the sessions older than the TTL."""
+
+    def __init__(self, backend, flush_interval: float, ttl: int):
+        self._backend = backend
+        self._flush_interval = flush_interval
+        self._ttl = ttl
+        self._pending: dict[str, tuple[dict, float]] = {}
+        self._lock = threading.Lock()
+        self.flushed = 0
+        self.restored = 0
+        self._expired = 0.0
+        self.expire()
+        threading.Thread(target=self._flush_forever, name='session_store', daemon=True).start()
+        atexit.register(self.flush)
+
+    def save(self, key: str, snapshot: dict) -> None:
+        with self._lock:
+            self._pending[key] = (snapshot, time.time())
+
+    def load(self, key: str) -> dict or None:
+        """The latest snapshot of a session, or None if it is not in the store."""
+        with self._lock:
+            pending = self._pending.get(key)
+        if pending is not None:
+            return pending[0]
+        data = self._backend.load(key, time.time() - self._ttl)
+        if data is None:
+            return None
+        self.restored += 1
+        return decode_session(data)
+
+    def flush(self) -> None:
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        try:
+            self._backend.save_many([(key, encode_session(snapshot), updated)
+                                     for key, (snapshot, updated) in pending.items()])
+            self.flushed += len(pending)
+        except Exception as _:
+            logging.exception(f"An error occurred saving {len(pending)} sessions. They will be saved in the next flush.")
+            with self._lock:
+                for key, entry in pending.items():
+                    self._pending.setdefault(key, entry)
+
+    def expire(self) -> None:
+        """Delete the sessions older than the TTL from the backend."""
+        self._expired = time.monotonic()
+        try:
+            self._backend.expire(time.time() - self._ttl)
+        except Exception as _:
+            logging.exception("An error occurred deleting the expired sessions.")
+
+    def _flush_forever(self) -> None:
+        while True:
+            time.sleep(self._flush_interval)
+            self.flush()
+            if time.monotonic() - self._expired >= self.EXPIRE_EVERY:
+                self.expire()
+
+
+def create_session_store(backend: str, sqlite_path: str, flush_interval: float, ttl: int) -> SessionStore or None:
+    """Create the session store with the configured backend, or None if the sessions are not stored."""
+    if backend == 'sqlite':
+        return SessionStore(SQLiteSessionBackend(sqlite_path), flush_interval, ttl)
+    if backend != 'none':
+        logging.error(f"Unknown session store backend '{backend}'. The sessions will not be stored.")
+    return None
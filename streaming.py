@@ -0,0 +1,43 @@
+from besser.bot.core.message import Message, MessageType
+from besser.bot.core.property import Property
+from datetime import datetime
+from typing import AsyncIterator, TYPE_CHECKING
+
+import asyncio
+import json
+import uuid
+
+if TYPE_CHECKING:
+    from besser.bot.core.session import Session
+
+SECTION_STREAMING = 'streaming'
+
+STREAMING_ENABLED = Property(SECTION_STREAMING, 'streaming.enabled', bool, True)
+"""Whether to send the LLM replies to the user chunk by chunk, as they are generated."""
+
+STREAM_ACTION = 'bot_reply_stream'
+"""Payload action of a chunk of a streamed reply. Its message is a dict with the reply 'id', the 'chunk' text and
+whether the reply is 'done'."""
+
+
+def send_chunk(platform, session: 'Session', stream_id: str, chunk: str, done: bool) -> None:
+    """Send a chunk of a streamed reply through the websocket connection of the session."""
+    connection = platform._connections.get(session.id)
+    if connection is not None:
+        connection.send(json.dumps({
+            'action': STREAM_ACTION,
+            'message': {'id': stream_id, 'chunk': chunk, 'done': done},
+        }))
+
+async def stream_reply(platform, session: 'Session', chunks: AsyncIterator[str]) -> str:
+    """Reply to the user with the chunks of an LLM answer as soon as they are generated. Returns the full reply.
+    The chunks are sent from a thread, as the websocket sends block and the event loop is shared by all the sessions."""
+    stream_id = str(uuid.uuid4())
+    reply = ""
+    async for chunk in chunks:
+        if chunk:
+            reply += chunk
+            await asyncio.to_thread(send_chunk, platform, session, stream_id, chunk, False)
+    await asyncio.to_thread(send_chunk, platform, session, stream_id, "", True)
+    session.save_message(Message(t=MessageType.STR, content=reply, is_user=False, timestamp=datetime.now()))
+    return reply
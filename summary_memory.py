@@ -0,0 +1,111 @@
+from langchain.memory.chat_memory import BaseChatMemory
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, get_buffer_string
+from langchain_core.pydantic_v1 import PrivateAttr
+from session_memory import MEMORY_MAX_TOKEN_LIMIT, run_summary
+from typing import Any, Dict, List
+
+import logging
+import threading
+
+MESSAGE_TYPES = {'human': HumanMessage, 'ai': AIMessage, 'system': SystemMessage}
+
+
+class SessionMemory(BaseChatMemory):
+    """Chat memory of a session with a token budget.
+
+    The recent messages are kept verbatim. When they exceed max_token_limit, the oldest ones are compressed into a
+    running summary by a background thread, so the user never waits for the summarization. The summary is generated
+    by the Agent, like the other LLM calls of the session (gateway, pool and token accounting).
+
+    Attributes:
+        agent (Agent): The Agent summarizing the history
+        max_token_limit (int): Maximum number of tokens of the messages kept verbatim
+        moving_summary_buffer (str): Summary of the older messages
+        prompts (int): The number of prompts sent to the LLM with this memory (only counted with token accounting)
+        prompt_tokens (int): The total number of tokens of those prompts
+    """
+    agent: Any
+    max_token_limit: int = MEMORY_MAX_TOKEN_LIMIT.default_value
+    moving_summary_buffer: str = ""
+    memory_key: str = "chat_history"
+    return_messages: bool = True
+    prompts: int = 0
+    prompt_tokens: int = 0
+    _lock: Any = PrivateAttr(default_factory=threading.RLock)
+    _pruning: bool = PrivateAttr(default=False)
+
+    @property
+    def memory_variables(self) -> List[str]:
+        return [self.memory_key]
+
+    def load_memory_variables(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        """The summary (as a system message) and the recent messages."""
+        with self._lock:
+            chat_history = list(self.chat_memory.messages)
+            if self.moving_summary_buffer:
+                chat_history.insert(0, SystemMessage(content=self.moving_summary_buffer))
+        return {self.memory_key: chat_history if self.return_messages else get_buffer_string(chat_history)}
+
+    def save_context(self, inputs: Dict[str, Any], outputs: Dict[str, str]) -> None:
+        with self._lock:
+            BaseChatMemory.save_context(self, inputs, outputs)
+            if self._pruning:
+                return
+            self._pruning = True
+        run_summary(self._prune)
+
+    def add_prompt_tokens(self, tokens: int) -> None:
+        with self._lock:
+            self.prompts += 1
+            self.prompt_tokens += tokens
+
+    def to_dict(self) -> dict:
+        """Compact serializable form of the memory: the type and content of every message, and the summary."""
+        with self._lock:
+            return {
+                'messages': [[message.type, message.content] for message in self.chat_memory.messages],
+                'summary': self.moving_summary_buffer,
+                'prompts': self.prompts,
+                'prompt_tokens': self.prompt_tokens,
+            }
+
+    def load_dict(self, data: dict) -> None:
+        """Restore the memory from its to_dict form."""
+        with self._lock:
+            self.chat_memory.messages = [MESSAGE_TYPES[type](content=content) for type, content in data['messages']]
+            self.moving_summary_buffer = data['summary']
+            prompt_tokens = data.get('prompt_tokens', 0)
+            if isinstance(prompt_tokens, list):
+                # Snapshots saved before the running totals have the tokens of every prompt
+                self.prompts, self.prompt_tokens = len(prompt_tokens), sum(prompt_tokens)
+            else:
+                self.prompts, self.prompt_tokens = data.get('prompts', 0), prompt_tokens
+
+    def clear(self) -> None:
+        with self._lock:
+            super().clear()
+            self.moving_summary_buffer = ""
+
+    def _prune(self) -> None:
+        """Summarize the oldest messages exceeding the token budget. The LLM is called without holding the lock, so
+        the session can keep reading and adding messages meanwhile (new messages are always appended at the end)."""
+        try:
+            with self._lock:
+                buffer = list(self.chat_memory.messages)
+                summary = self.moving_summary_buffer
+            tokens = [self.agent.llm.get_num_tokens_from_messages([message]) for message in buffer]
+            total, pruned = sum(tokens), 0
+            while total > self.max_token_limit and pruned < len(buffer):
+                total -= tokens[pruned]
+                pruned += 1
+            if not pruned:
+                return
+            new_summary = self.agent.summarize(buffer[:pruned], summary)
+            with self._lock:
+                del self.chat_memory.messages[:pruned]
+                self.moving_summary_buffer = new_summary
+        except Exception as _:
+            logging.exception("An error occurred summarizing the chat history.")
+        finally:
+            with self._lock:
+                self._pruning = False
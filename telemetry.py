@@ -0,0 +1,258 @@
+from besser.bot.core.property import Property
+from bisect import bisect_left
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable
+
+import itertools
+import logging
+import random
+import threading
+import time
+
+SECTION_TELEMETRY = 'telemetry'
+
+TELEMETRY_ENABLED = Property(SECTION_TELEMETRY, 'telemetry.enabled', bool, False)
+"""Whether to record the spans and metrics of the turns. When disabled, the instrumentation does nothing."""
+
+TELEMETRY_SAMPLE_RATE = Property(SECTION_TELEMETRY, 'telemetry.sample_rate', float, 0.1)
+"""Fraction of the turns whose spans, latencies and token counts are recorded (the token counts of a sampled turn
+may need a local tokenization)."""
+
+TELEMETRY_EXPORTER_PORT = Property(SECTION_TELEMETRY, 'telemetry.exporter_port', int, 0)
+"""Port of the HTTP endpoint serving the metrics in the Prometheus text format at /metrics (0 means no endpoint)."""
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+
+
+def format_labels(labels: tuple) -> str:
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}" if labels else ""
+
+
+class Counter:
+    """Prometheus counter, by label values."""
+    type = 'counter'
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            return [f"{self.name}{format_labels(labels)} {value}" for labels, value in self._values.items()]
+
+
+class Histogram:
+    """Prometheus histogram with fixed buckets, by label values."""
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, buckets: tuple):
+        self.name = name
+        self.help = help
+        self._buckets = buckets
+        self._values: dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # One count per bucket, plus the +Inf bucket, the sum and the count
+                counts = self._values[key] = [0] * (len(self._buckets) + 1) + [0.0, 0]
+            counts[bisect_left(self._buckets, value)] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def samples(self) -> list[str]:
+        samples = []
+        with self._lock:
+            for labels, counts in self._values.items():
+                for bound, cumulative in zip(self._buckets + ('+Inf',), itertools.accumulate(counts[:-2])):
+                    samples.append(f"{self.name}_bucket{format_labels(labels + (('le', bound),))} {cumulative}")
+                samples.append(f"{self.name}_sum{format_labels(labels)} {counts[-2]}")
+                samples.append(f"{self.name}_count{format_labels(labels)} {counts[-1]}")
+        return samples
+
+
+class Gauge:
+    """Prometheus gauge read from a function when the metrics are exported. The function returns a number, or a dict
+    of numbers by the value of the gauge label."""
+    type = 'gauge'
+
+    def __init__(self, name: str, help: str, read: Callable[[], Any], label: str = None):
+        self.name = name
+        self.help = help
+        self._read = read
+        self._label = label
+
+    def samples(self) -> list[str]:
+        value = self._read()
+        if self._label is None:
+            return [f"{self.name} {value}"]
+        return [f"{self.name}{format_labels(((self._label, key),))} {item}" for key, item in value.items()]
+
+
+SPAN_SECONDS = Histogram('cbt_span_seconds', 'Duration of the spans of the turns', LATENCY_BUCKETS)
+TURN_STEP_SECONDS = Histogram('cbt_turn_step_seconds', 'Latency breakdown of the LLM pipeline of the turns',
+                              LATENCY_BUCKETS)
+LLM_TOKENS = Histogram('cbt_llm_tokens', 'Tokens of the LLM prompts and responses', TOKEN_BUCKETS)
+SPAN_ERRORS = Counter('cbt_span_errors_total', 'Spans that ended with an exception')
+_metrics: list = [SPAN_SECONDS, TURN_STEP_SECONDS, LLM_TOKENS, SPAN_ERRORS]
+
+_enabled = False
+_sample_rate = 1.0
+_trace_ids = itertools.count(1)
+_trace: ContextVar['Trace' or None] = ContextVar('trace', default=None)
+
+
+def configure(enabled: bool, sample_rate: float) -> None:
+    global _enabled, _sample_rate
+    _enabled = enabled
+    _sample_rate = sample_rate
+
+def add_metric(metric: Counter or Histogram or Gauge) -> Counter or Histogram or Gauge:
+    """Export a metric created by another module."""
+    _metrics.append(metric)
+    return metric
+
+def add_gauge(name: str, help: str, read: Callable[[], Any], label: str = None) -> None:
+    add_metric(Gauge(name, help, read, label))
+
+def add_stats(name: str, help: str, stats: Callable[[], dict]) -> None:
+    """Export the numeric values of the stats() of a component as a gauge, by stat."""
+    add_gauge(name, help, lambda: {key: float(value) for key, value in stats().items()
+                                   if isinstance(value, (int, float))}, label='stat')
+
+def render_metrics() -> str:
+    """All the metrics in the Prometheus text format."""
+    lines = []
+    for metric in _metrics:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        try:
+            lines.extend(metric.samples())
+        except Exception as e:
+            logging.error(f"An error occurred reading the metric {metric.name}: {e}")
+    return "\n".join(lines) + "\n"
+
+
+class Span:
+    """A timed operation of a sampled turn. It records its duration and logs it (with its attributes) at debug level."""
+    __slots__ = ('kind', 'name', 'trace', 'attributes', '_start')
+    sampled = True
+
+    def __init__(self, kind: str, name: str, trace: 'Trace'):
+        self.kind = kind
+        self.name = name
+        self.trace = trace
+        self.attributes = {}
+
+    def set(self, **attributes) -> None:
+        self.attributes.update(attributes)
+
+    def __enter__(self) -> 'Span':
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        duration = time.perf_counter() - self._start
+        SPAN_SECONDS.observe(duration, kind=self.kind, name=self.name)
+        if exc_type is not None:
+            SPAN_ERRORS.inc(kind=self.kind, name=self.name, error=exc_type.__name__)
+        logging.debug(f"[trace {self.trace.id}] {self.kind} '{self.name}' {duration * 1000:.1f}ms {self.attributes}"
+                      + (f" failed with {exc_type.__name__}" if exc_type is not None else ""))
+
+
+class Trace(Span):
+    """The root span of a turn (a state body). Its spans are recorded only if it is sampled."""
+    __slots__ = ('id', '_token')
+
+    def __init__(self, name: str):
+        super().__init__('state', name, self)
+        self.id = next(_trace_ids)
+
+    def __enter__(self) -> 'Trace':
+        self._token = _trace.set(self)
+        return super().__enter__()
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        super().__exit__(exc_type, exc_value, traceback)
+        _trace.reset(self._token)
+
+
+class NoSpan:
+    """Span of a disabled or not sampled turn: it does nothing."""
+    sampled = False
+
+    def set(self, **attributes) -> None:
+        pass
+
+    def __enter__(self) -> 'NoSpan':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        pass
+
+
+NO_SPAN = NoSpan()
+
+
+def trace(name: str) -> Trace or NoSpan:
+    """Start the trace of a turn, if the telemetry is enabled and the turn is sampled."""
+    if not _enabled or random.random() >= _sample_rate:
+        return NO_SPAN
+    return Trace(name)
+
+def span(kind: str, name: str) -> Span or NoSpan:
+    """Start a span in the trace of the current turn, if it is sampled."""
+    current = _trace.get() if _enabled else None
+    if current is None:
+        return NO_SPAN
+    return Span(kind, name, current)
+
+def sampled() -> bool:
+    return _enabled and _trace.get() is not None
+
+def observe_turn(latency: dict) -> None:
+    """Record the latency breakdown of the LLM pipeline of a sampled turn."""
+    if sampled():
+        for step, seconds in latency.items():
+            TURN_STEP_SECONDS.observe(seconds, step=step)
+
+def observe_tokens(prompt: str, prompt_tokens: int, response_tokens: int) -> None:
+    LLM_TOKENS.observe(prompt_tokens, prompt=prompt, direction='prompt')
+    LLM_TOKENS.observe(response_tokens, prompt=prompt, direction='response')
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        data = render_metrics().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def start_exporter(host: str, port: int) -> None:
+    """Serve the metrics at http://host:port/metrics in a background thread."""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='telemetry_exporter', daemon=True).start()
+    logging.info(f"Metrics exported at http://{host}:{port}/metrics")
@@ -0,0 +1,91 @@
+from abc_data import ABCRecord, CBTData, merge_abc_information, parse_abc_information
+
+
+def records(*fields: tuple[str, str, str]) -> list[ABCRecord]:
+    return [ABCRecord(*record) for record in fields]
+
+
+def test_merge_fills_missing_fields():
+    current = records(("I failed my exam", "", ""))
+    new = records(("", "I am not smart enough", "I stayed at home"))
+    merged, conflicts = merge_abc_information(current, new)
+    assert [record.to_dict() for record in merged] == [
+        {'activating_event': "I failed my exam", 'beliefs_in_event': "I am not smart enough",
+         'consequences': "I stayed at home"}]
+    assert conflicts == []
+
+
+def test_merge_deduplicates_similar_events():
+    current = records(("I failed my exam.", "I am stupid", ""))
+    new = records(("i failed my exam", "I am stupid!", "I cried"))
+    merged, conflicts = merge_abc_information(current, new)
+    assert len(merged) == 1
+    assert merged[0].beliefs_in_event == "I am stupid"
+    assert merged[0].consequences == "I cried"
+    assert conflicts == []
+
+
+def test_merge_appends_different_events():
+    current = records(("I failed my exam", "I am stupid", "I cried"))
+    new = records(("My partner left me", "Nobody loves me", "I did not eat"))
+    merged, conflicts = merge_abc_information(current, new)
+    assert [record.activating_event for record in merged] == ["I failed my exam", "My partner left me"]
+    assert conflicts == []
+
+
+def test_merge_reports_contradicting_fields():
+    current = records(("I failed my exam", "I am stupid", "I cried"))
+    new = records(("I failed my exam", "The teacher hates me", ""))
+    merged, conflicts = merge_abc_information(current, new)
+    assert merged[0].beliefs_in_event == "I am stupid; The teacher hates me"
+    assert conflicts == [0]
+
+
+def test_merge_keeps_the_more_detailed_value():
+    current = records(("I failed my exam", "I am stupid", ""))
+    new = records(("I failed my exam", "I am stupid and I will never graduate", ""))
+    merged, conflicts = merge_abc_information(current, new)
+    assert merged[0].beliefs_in_event == "I am stupid and I will never graduate"
+    assert conflicts == []
+
+
+def test_merge_does_not_modify_the_current_records():
+    current = records(("I failed my exam", "", ""))
+    merge_abc_information(current, records(("", "I am stupid", "")))
+    assert current[0].beliefs_in_event == ""
+
+
+def test_merge_skips_empty_records():
+    merged, _ = merge_abc_information([], records(("", "", "")))
+    assert merged == []
+
+
+def test_cbt_data_flags():
+    data = CBTData()
+    assert not data.complete
+    conflicts = data.merge([{'activating_event': "I failed my exam"}], threshold=0.75)
+    assert conflicts == []
+    assert data.missing_beliefs and not data.complete
+    data.merge([{'beliefs_in_event': "I am stupid", 'consequences': "I cried"}], threshold=0.75)
+    assert data.complete and not data.missing_beliefs
+
+
+def test_missing_summary():
+    data = CBTData(records(("I failed my exam", "", ""), ("", "", ""), ("", "Nobody loves me", ""),
+                           ("My partner left me", "I am alone", "I cried")))
+    assert data.missing_summary(3) == (
+        '- activating_event: "I failed my exam" (missing beliefs_in_event, consequences)\n'
+        '- beliefs_in_event: "Nobody loves me" (missing activating_event, consequences)')
+    assert data.missing_summary(1) == '- beliefs_in_event: "Nobody loves me" (missing activating_event, consequences)'
+
+
+def test_missing_summary_complete():
+    assert CBTData(records(("I failed my exam", "I am stupid", "I cried"))).missing_summary(3) == ""
+
+
+def test_parse_abc_information():
+    parsed = parse_abc_information('[{"activating_event": " I failed ", "beliefs_in_event": null}, {}]')
+    assert [record.to_dict() for record in parsed] == [
+        {'activating_event': "I failed", 'beliefs_in_event': "", 'consequences': ""}]
+    assert parse_abc_information('not json') is None
+    assert parse_abc_information('{"activating_event": "I failed"}') is None
@@ -0,0 +1,41 @@
+from batch_extract import load_checkpoint, read_records
+
+import io
+import json
+
+
+def test_load_checkpoint_missing_file(tmp_path):
+    assert load_checkpoint(str(tmp_path / 'output.jsonl')) == set()
+
+
+def test_load_checkpoint_truncates_partial_line(tmp_path):
+    path = tmp_path / 'output.jsonl'
+    complete = json.dumps({'id': 1, 'abc_information': []}) + "\n" + json.dumps({'id': 'b', 'abc_information': []}) + "\n"
+    path.write_text(complete + '{"id": "c", "abc_inf')
+    assert load_checkpoint(str(path)) == {'1', 'b'}
+    assert path.read_text() == complete
+
+
+def test_load_checkpoint_truncates_invalid_line(tmp_path):
+    path = tmp_path / 'output.jsonl'
+    complete = json.dumps({'id': 1}) + "\n"
+    path.write_text(complete + "not json\n" + json.dumps({'id': 2}) + "\n")
+    assert load_checkpoint(str(path)) == {'1'}
+    assert path.read_text() == complete
+
+
+def test_read_records(tmp_path):
+    path = tmp_path / 'input.jsonl'
+    path.write_text("\n".join([
+        json.dumps({'id': 'a', 'text': "I failed my exam"}),
+        json.dumps({'id': 'b', 'text': "Already done"}),
+        "",
+        json.dumps({'text': "No id"}),
+        "not json",
+        json.dumps({'id': 'e'}),
+        json.dumps(["not", "an", "object"]),
+    ]) + "\n")
+    errors = io.StringIO()
+    records = list(read_records(str(path), 'id', 'text', {'b'}, errors))
+    assert records == [('a', "I failed my exam"), ('4', "No id")]
+    assert [json.loads(line)['line'] for line in errors.getvalue().splitlines()] == [5, 6, 7]
@@ -0,0 +1,66 @@
+from llm_cache import MemoryCacheBackend, ResponseCache, SQLiteCacheBackend, create_cache
+
+import llm_cache
+import pytest
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(llm_cache.time, 'time', clock.time)
+    return clock
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def backend(request, tmp_path):
+    if request.param == 'memory':
+        return MemoryCacheBackend(max_entries=2, ttl=60)
+    return SQLiteCacheBackend(str(tmp_path / 'cache.sqlite'), max_entries=2, ttl=60)
+
+
+def test_lru_eviction(backend, clock):
+    backend.set('a', '1')
+    clock.now += 1
+    backend.set('b', '2')
+    clock.now += 1
+    assert backend.get('a') == '1'
+    clock.now += 1
+    backend.set('c', '3')
+    assert backend.get('b') is None
+    assert backend.get('a') == '1'
+    assert backend.get('c') == '3'
+
+
+def test_ttl_eviction(backend, clock):
+    backend.set('a', '1')
+    clock.now += 60
+    assert backend.get('a') == '1'
+    clock.now += 1
+    assert backend.get('a') is None
+
+
+def test_response_cache_round_trip(clock):
+    cache = ResponseCache(MemoryCacheBackend(max_entries=10, ttl=60))
+    cache.set('key', [{'activating_event': "I failed"}])
+    assert cache.get('key') == [{'activating_event': "I failed"}]
+    assert cache.get('other') is None
+    assert cache.stats() == {'hits': 1, 'misses': 1, 'hit_rate': 0.5}
+
+
+def test_key_normalizes_prompts():
+    assert ResponseCache.key('model', "Hello   World") == ResponseCache.key('model', "hello world")
+    assert ResponseCache.key('model', "Hello World") != ResponseCache.key('other', "Hello World")
+
+
+def test_create_cache(tmp_path):
+    assert not create_cache('memory', 10, 60, '', False).blocking
+    assert create_cache('sqlite', 10, 60, str(tmp_path / 'cache.sqlite'), False).blocking
+    assert create_cache('none', 10, 60, '', False) is None
@@ -0,0 +1,72 @@
+from llm_gateway import TokenBucket, is_retryable, retry_after
+from types import SimpleNamespace
+
+import llm_gateway
+import pytest
+
+
+class APIError(Exception):
+    def __init__(self, status_code: int = None, headers: dict = None):
+        super().__init__(status_code)
+        self.status_code = status_code
+        self.response = SimpleNamespace(headers=headers or {})
+
+
+class APITimeoutError(Exception):
+    pass
+
+
+@pytest.fixture
+def clock(monkeypatch) -> SimpleNamespace:
+    clock = SimpleNamespace(now=0.0)
+    monkeypatch.setattr(llm_gateway.time, 'monotonic', lambda: clock.now)
+    return clock
+
+
+def test_token_bucket_capacity(clock):
+    bucket = TokenBucket(60)
+    assert bucket.reserve(60) == 0.0
+    assert bucket.reserve(1) == pytest.approx(1.0)
+
+
+def test_token_bucket_debt_spreads_requests(clock):
+    bucket = TokenBucket(60)
+    bucket.reserve(60)
+    assert bucket.reserve(30) == pytest.approx(30.0)
+    assert bucket.reserve(30) == pytest.approx(60.0)
+    clock.now += 60
+    assert bucket.reserve(1) == pytest.approx(1.0)
+
+
+def test_token_bucket_refill(clock):
+    bucket = TokenBucket(60)
+    bucket.reserve(60)
+    clock.now += 30
+    assert bucket.reserve(30) == 0.0
+    clock.now += 1000
+    assert bucket.reserve(60) == 0.0
+
+
+def test_token_bucket_large_request(clock):
+    bucket = TokenBucket(60)
+    # A request larger than the capacity takes the whole bucket, instead of waiting forever
+    assert bucket.reserve(1000) == 0.0
+    assert bucket.reserve(60) == pytest.approx(60.0)
+
+
+@pytest.mark.parametrize('error', [APIError(429), APIError(500), APIError(503), APITimeoutError(), TimeoutError(),
+                                   ConnectionResetError()])
+def test_retryable_errors(error):
+    assert is_retryable(error)
+
+
+@pytest.mark.parametrize('error', [APIError(400), APIError(401), APIError(404), ValueError(), KeyError()])
+def test_non_retryable_errors(error):
+    assert not is_retryable(error)
+
+
+def test_retry_after():
+    assert retry_after(APIError(429, {'retry-after': '2.5'})) == 2.5
+    assert retry_after(APIError(429)) is None
+    assert retry_after(APIError(429, {'retry-after': 'soon'})) is None
+    assert retry_after(TimeoutError()) is None
@@ -0,0 +1,35 @@
+from message_filter import SMALL_TALK, ExtractionFilter
+
+OPTIONS = ['Yes, I had bad thoughts or feelings.', 'No, I am good.']
+
+
+def extraction_filter() -> ExtractionFilter:
+    return ExtractionFilter(options=OPTIONS, small_talk=SMALL_TALK, min_words=3)
+
+
+def test_skip_options_and_small_talk():
+    message_filter = extraction_filter()
+    assert message_filter.skip_reason("yes, I had bad thoughts or feelings") == 'option'
+    assert message_filter.skip_reason("Thank you!") == 'small_talk'
+    assert message_filter.skip_reason("Thank you!", answer=True) == 'small_talk'
+
+
+def test_skip_short_messages_unless_answers():
+    message_filter = extraction_filter()
+    assert message_filter.skip_reason("Got fired.") == 'short'
+    assert message_filter.skip_reason("Got fired.", answer=True) is None
+
+
+def test_extract_situations():
+    message_filter = extraction_filter()
+    assert message_filter.skip_reason("My boss shouted at me in front of everyone") is None
+    assert message_filter.skip_reason("") == 'short'
+
+
+def test_skip_counts_reasons():
+    message_filter = extraction_filter()
+    assert message_filter.skip("hello")
+    assert message_filter.skip("ok")
+    assert message_filter.skip("Got fired")
+    assert not message_filter.skip("My boss shouted at me")
+    assert message_filter.skipped == {'small_talk': 2, 'short': 1}
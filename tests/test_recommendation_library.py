@@ -0,0 +1,84 @@
+from abc_data import ABCRecord
+from recommendation_library import RECOMMENDATIONS_MIN_SCORE, create_recommendation_library
+
+import os
+import pytest
+
+LIBRARY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'recommendation_library.json')
+
+DISTORTED_BELIEFS = [
+    ("My life is over, I will never recover from this.", 'catastrophizing'),
+    ("It was a total disaster and I can't cope with it.", 'catastrophizing'),
+    ("Everyone at work thinks I am stupid.", 'mind_reading'),
+    ("I always fail at everything I try.", 'overgeneralization'),
+    ("Nothing ever works out for me, nobody cares about me.", 'overgeneralization'),
+    ("I am a complete failure.", 'labeling'),
+    ("I'm a loser, I'm not smart enough for this job.", 'labeling'),
+    ("I should have known better, I must be perfect at my job.", 'should_statements'),
+    ("I know I'm going to fail the exam.", 'fortune_telling'),
+    ("I will never find a partner, I'm sure I will be alone forever.", 'fortune_telling'),
+    ("It's all my fault, I ruined everything.", 'personalization'),
+    ("I feel like a failure, so I must be one.", 'emotional_reasoning'),
+]
+
+ORDINARY_BELIEFS = [
+    "I always have coffee before work.",
+    "I never eat breakfast, I'm not hungry in the morning.",
+    "Nothing for me, thanks, I already ate.",
+    "I know I will see my sister again next week.",
+    "I'm sure it will rain again tomorrow.",
+    "Definitely, I will call him again after the meeting.",
+    "I am not ready yet, I need one more week to prepare.",
+    "I'm never late to meetings.",
+    "I am not sure what to do about the offer.",
+    "My life has changed a lot since I moved.",
+    "I should call my mother this weekend.",
+    "I feel tired after a long day at work.",
+    "The meeting is over and everything went fine.",
+    "Everyone was at the party and I had fun.",
+    "I think the presentation could have gone better, but I learned a lot.",
+    "I was disappointed, but I can try again next month.",
+    "I felt nervous before the interview.",
+    "I'm going to the gym again on Monday.",
+]
+
+
+@pytest.fixture(scope='module')
+def library():
+    return create_recommendation_library(LIBRARY, RECOMMENDATIONS_MIN_SCORE.default_value)
+
+
+@pytest.mark.parametrize('belief, distortion', DISTORTED_BELIEFS)
+def test_match_distorted_belief(library, belief, distortion):
+    match = library.match(belief)
+    assert match is not None and match.name == distortion
+
+
+@pytest.mark.parametrize('belief', ORDINARY_BELIEFS)
+def test_no_match_ordinary_belief(library, belief):
+    assert library.match(belief) is None
+
+
+def test_no_single_pattern_reaches_min_score(library):
+    for distortion in library._distortions:
+        for pattern, weight in distortion.patterns:
+            assert weight < RECOMMENDATIONS_MIN_SCORE.default_value, (distortion.name, pattern.pattern)
+
+
+def test_corpus_false_positive_rate(library):
+    matches = [belief for belief in ORDINARY_BELIEFS if library.match(belief) is not None]
+    assert not matches
+
+
+def test_recommend_all_beliefs(library):
+    records = [ABCRecord(activating_event="I failed the exam", beliefs_in_event="I am a complete failure."),
+               ABCRecord(activating_event="My friend didn't call", beliefs_in_event="It's all my fault, I ruined everything.")]
+    recommendation = library.recommend(records)
+    assert recommendation.count("You said") == 2
+    assert "I am a complete failure." in recommendation
+
+
+def test_recommend_unmatched_belief(library):
+    records = [ABCRecord(activating_event="I failed the exam", beliefs_in_event="I am a complete failure."),
+               ABCRecord(activating_event="I moved", beliefs_in_event="My life has changed a lot since I moved.")]
+    assert library.recommend(records) is None
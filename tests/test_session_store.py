@@ -0,0 +1,48 @@
+from session_store import SQLiteSessionBackend, SessionStore, create_session_store, decode_session, encode_session
+
+import time
+
+SNAPSHOT = {
+    'state': 'question_state',
+    'memory': {'messages': [{'type': 'human', 'content': "I failed my exam"}], 'moving_summary_buffer': ""},
+    'cbt_struct_data': [{'activating_event': "I failed my exam", 'beliefs_in_event': "", 'consequences': ""}],
+    'transcript': [["I failed my exam", True], ["What did you think?", False]],
+}
+
+
+def store(path: str, ttl: int = 3600) -> SessionStore:
+    return SessionStore(SQLiteSessionBackend(path), flush_interval=3600, ttl=ttl)
+
+
+def test_encode_round_trip():
+    assert decode_session(encode_session(SNAPSHOT)) == SNAPSHOT
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / 'sessions.sqlite')
+    sessions = store(path)
+    sessions.save('key', SNAPSHOT)
+    assert sessions.load('key') == SNAPSHOT
+    sessions.flush()
+    assert sessions.flushed == 1
+    # Another process (or bot replica) reads it from the backend
+    other = store(path)
+    assert other.load('key') == SNAPSHOT
+    assert other.restored == 1
+    assert other.load('unknown') is None
+
+
+def test_expired_sessions_are_not_restored(tmp_path):
+    path = str(tmp_path / 'sessions.sqlite')
+    backend = SQLiteSessionBackend(path)
+    backend.save_many([('old', encode_session(SNAPSHOT), time.time() - 120),
+                       ('new', encode_session(SNAPSHOT), time.time())])
+    sessions = store(path, ttl=60)
+    assert sessions.load('old') is None
+    assert sessions.load('new') == SNAPSHOT
+    assert backend.load('old', 0) is None
+
+
+def test_create_session_store(tmp_path):
+    assert create_session_store('none', '', 2.0, 60) is None
+    assert isinstance(create_session_store('sqlite', str(tmp_path / 'sessions.sqlite'), 2.0, 60), SessionStore)
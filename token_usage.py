@@ -0,0 +1,139 @@
+from besser.bot.core.property import Property
+from contextlib import contextmanager
+from contextvars import ContextVar
+from telemetry import Counter, add_metric
+
+import logging
+import threading
+
+SECTION_BUDGET = 'budget'
+
+BUDGET_SESSION_TOKENS = Property(SECTION_BUDGET, 'budget.session_tokens', int, 0)
+"""LLM tokens (prompt and completion) a session can use before it switches to the cheaper paths: the economy
+deployments of the LLM pool, no LLM conflict resolution and no personalization of the library recommendations.
+0 means no budget."""
+
+BUDGET_PROMPT_TOKEN_COST = Property(SECTION_BUDGET, 'budget.prompt_token_cost', float, 0.0)
+"""Cost of 1000 prompt tokens, to report the cost of the sessions."""
+
+BUDGET_COMPLETION_TOKEN_COST = Property(SECTION_BUDGET, 'budget.completion_token_cost', float, 0.0)
+"""Cost of 1000 completion tokens, to report the cost of the sessions."""
+
+TOKENS = add_metric(Counter('cbt_llm_tokens_total', 'LLM tokens used by the sessions, by state and prompt'))
+COST = add_metric(Counter('cbt_llm_cost_total', 'Cost of the LLM tokens used by the sessions, by state and prompt'))
+SESSIONS_OVER_BUDGET = add_metric(Counter('cbt_sessions_over_budget_total', 'Sessions that exceeded their token budget'))
+
+_enabled = False
+_prompt_token_cost = 0.0
+_completion_token_cost = 0.0
+_usage: ContextVar[tuple['TokenUsage', str] or None] = ContextVar('token_usage', default=None)
+
+
+def configure(enabled: bool, prompt_token_cost: float, completion_token_cost: float) -> None:
+    """Enable the accounting (only needed for a budget or the telemetry, as it counts the tokens of every LLM call)
+    and set the token costs."""
+    global _enabled, _prompt_token_cost, _completion_token_cost
+    _enabled = enabled
+    _prompt_token_cost = prompt_token_cost
+    _completion_token_cost = completion_token_cost
+
+def token_cost(prompt_tokens: int, completion_tokens: int) -> float:
+    return (prompt_tokens * _prompt_token_cost + completion_tokens * _completion_token_cost) / 1000
+
+
+def copy_totals(totals: dict[str, list[int]]) -> dict[str, list[int]]:
+    return {name: list(tokens) for name, tokens in totals.items()}
+
+
+class TokenUsage:
+    """LLM token usage of a session, in total and by state and prompt.
+
+    Attributes:
+        budget (int): Tokens the session can use before switching to the cheaper paths (0 means no budget)
+        prompt_tokens (int): Prompt tokens used by the session
+        completion_tokens (int): Completion tokens used by the session
+        by_state (dict[str, list[int]]): Prompt and completion tokens by state
+        by_prompt (dict[str, list[int]]): Prompt and completion tokens by prompt
+    """
+
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.by_state: dict[str, list[int]] = {}
+        self.by_prompt: dict[str, list[int]] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def total(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    @property
+    def over_budget(self) -> bool:
+        return 0 < self.budget <= self.total
+
+    @property
+    def cost(self) -> float:
+        return token_cost(self.prompt_tokens, self.completion_tokens)
+
+    def add(self, state: str, prompt: str, prompt_tokens: int, completion_tokens: int) -> bool:
+        """Count the tokens of an LLM call. Returns whether the session went over its budget with it."""
+        with self._lock:
+            was_over_budget = self.over_budget
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+            for totals in (self.by_state.setdefault(state, [0, 0]), self.by_prompt.setdefault(prompt, [0, 0])):
+                totals[0] += prompt_tokens
+                totals[1] += completion_tokens
+            return self.over_budget and not was_over_budget
+
+    def to_dict(self) -> dict:
+        """A copy of the usage, so it can be serialized while the session keeps counting tokens."""
+        with self._lock:
+            return {'prompt_tokens': self.prompt_tokens, 'completion_tokens': self.completion_tokens,
+                    'by_state': copy_totals(self.by_state), 'by_prompt': copy_totals(self.by_prompt)}
+
+    def load_dict(self, data: dict) -> None:
+        """Restore the usage from its to_dict form (the budget is kept)."""
+        with self._lock:
+            self.prompt_tokens = data['prompt_tokens']
+            self.completion_tokens = data['completion_tokens']
+            self.by_state = copy_totals(data['by_state'])
+            self.by_prompt = copy_totals(data['by_prompt'])
+
+
+@contextmanager
+def accounting(usage: TokenUsage, state: str):
+    """Count the tokens of the LLM calls made in the context (e.g. a state body) in the usage of a session, if the
+    accounting is enabled."""
+    if not _enabled:
+        yield usage
+        return
+    token = _usage.set((usage, state))
+    try:
+        yield usage
+    finally:
+        _usage.reset(token)
+
+def accounting_active() -> bool:
+    return _usage.get() is not None
+
+def over_budget() -> bool:
+    """Whether the session of the current context is over its token budget."""
+    current = _usage.get()
+    return current is not None and current[0].over_budget
+
+def record(prompt: str, prompt_tokens: int, completion_tokens: int) -> None:
+    """Count the tokens of an LLM call in the session of the current context and in the aggregates by state and prompt."""
+    current = _usage.get()
+    if current is None:
+        return
+    usage, state = current
+    TOKENS.inc(prompt_tokens, state=state, prompt=prompt, direction='prompt')
+    TOKENS.inc(completion_tokens, state=state, prompt=prompt, direction='completion')
+    if _prompt_token_cost or _completion_token_cost:
+        COST.inc(token_cost(prompt_tokens, completion_tokens), state=state, prompt=prompt)
+    if usage.add(state, prompt, prompt_tokens, completion_tokens):
+        SESSIONS_OVER_BUDGET.inc()
+        logging.warning(f"A session is over its budget of {usage.budget} tokens ({usage.total} tokens, cost "
+                        f"{usage.cost:.4f}) in '{state}'. It switches to the cheaper paths")
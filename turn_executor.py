@@ -0,0 +1,89 @@
+from besser.bot.core.property import Property
+from typing import Any, Awaitable, Callable
+
+import asyncio
+import logging
+import threading
+import time
+import weakref
+
+SECTION_EXECUTOR = 'executor'
+
+EXECUTOR_ASYNC = Property(SECTION_EXECUTOR, 'executor.async', bool, True)
+"""Whether to run the LLM pipelines of all the sessions in a shared event loop. Otherwise every turn runs its own."""
+
+EXECUTOR_WORKERS = Property(SECTION_EXECUTOR, 'executor.workers', int, 16)
+"""Maximum number of turns running their LLM pipeline at the same time. The other turns wait in a queue."""
+
+
+class TurnExecutor:
+    """Runs the async LLM pipelines of the turns of all the sessions in a shared event loop (in a background thread).
+
+    At most `workers` turns run at the same time, and the turns of a session run in the order they were submitted. The
+    thread of the session waits for its turn to finish, so the bot transitions see the result of the state body, while
+    the LLM calls of a slow turn don't hold the other sessions. The blocking work of the turns (websocket sends, token
+    counting, CPU-heavy merges) must run in a thread (asyncio.to_thread), or it stalls every session.
+
+    Attributes:
+        workers (int): Maximum number of turns running at the same time
+        queued (int): Number of turns waiting for a worker
+        running (int): Number of turns running
+        completed (int): Number of finished turns
+        total_wait (float): Seconds the finished turns spent waiting for a worker
+        max_wait (float): Longest wait for a worker, in seconds
+    """
+
+    REPORT_EVERY = 100
+    """Number of turns between two metrics log messages."""
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self._lock = threading.Lock()
+        self._loop = asyncio.new_event_loop()
+        self._semaphore = asyncio.Semaphore(workers)
+        self._session_locks: weakref.WeakValueDictionary[str, asyncio.Lock] = weakref.WeakValueDictionary()
+        threading.Thread(target=self._loop.run_forever, name='turn_executor', daemon=True).start()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'queued': self.queued,
+                'running': self.running,
+                'completed': self.completed,
+                'mean_wait': self.total_wait / self.completed if self.completed else 0.0,
+                'max_wait': self.max_wait,
+            }
+
+    def run(self, session_id: str, turn: Callable[[], Awaitable]) -> tuple[Any, float]:
+        """Run the coroutine of a turn of a session and wait for it. Returns its result and the seconds it waited
+        for a worker."""
+        with self._lock:
+            self.queued += 1
+        return asyncio.run_coroutine_threadsafe(self._run(session_id, turn, time.perf_counter()), self._loop).result()
+
+    async def _run(self, session_id: str, turn: Callable[[], Awaitable], submitted: float) -> tuple[Any, float]:
+        session_lock = self._session_locks.get(session_id)
+        if session_lock is None:
+            session_lock = self._session_locks[session_id] = asyncio.Lock()
+        async with session_lock, self._semaphore:
+            wait = time.perf_counter() - submitted
+            with self._lock:
+                self.queued -= 1
+                self.running += 1
+            try:
+                return await turn(), wait
+            finally:
+                with self._lock:
+                    self.running -= 1
+                    self.completed += 1
+                    self.total_wait += wait
+                    self.max_wait = max(self.max_wait, wait)
+                    report = self.completed % self.REPORT_EVERY == 0
+                if report:
+                    logging.info(f"Turn executor: {self.stats()}")